@@ -1,37 +1,558 @@
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
 import os
 import pathlib
 import subprocess
+import tempfile
+import threading
 
-from . import charm, checkout
+import requests
+import yaml
+
+from . import charm, checkout, collect_bases, github, lxd, release, timing, wheelhouse
+
+# Directory in `CRAFT_SHARED_CACHE` used by charmcraft 2 for each base
+# Release archives contain the contents of this directory
+_CHARMCRAFT_BASE_CACHE_DIRECTORY_NAME = "charmcraft-buildd-base-v7"
+# Directory in `_CHARMCRAFT_BASE_CACHE_DIRECTORY_NAME` used by charmcraft 2 for each Ubuntu
+# version. Mounted at /root/.cache/ in charmcraft's LXD instance
+_CHARMCRAFT_BASE_ALIASES = {
+    "20.04": "BuilddBaseAlias.FOCAL",
+    "22.04": "BuilddBaseAlias.JAMMY",
+    "24.04": "BuilddBaseAlias.NOBLE",
+}
+# Keys of charm part that `_build_wheels` reproduces (or that do not affect the pip cache)
+# Other keys (e.g. "build-snaps", "override-build", "build-environment", "after") can change the
+# environment that wheels are built in; charms that use them are packed with charmcraft
+_WHEELS_ONLY_CHARM_PART_KEYS = {
+    "plugin",
+    "source",
+    "build-packages",
+    "charm-binary-python-packages",
+    "charm-python-packages",
+    "charm-requirements",
+    "charm-strict-dependencies",
+    "charm-entrypoint",
+    "prime",
+}
+
+
+def _dependency_hash(
+    charm_dir: pathlib.Path, *, charmcraft_yaml: dict, base: collect_bases.Base
+) -> str:
+    """Hash of inputs that determine which wheels are built for charm base"""
+    charm_part = charmcraft_yaml.get("parts", {}).get("charm", {})
+    requirements_files = [
+        "requirements.txt",
+        "poetry.lock",
+        *charm_part.get("charm-requirements", []),
+    ]
+    files = {}
+    for name in requirements_files:
+        path = charm_dir / name
+        files[name] = path.read_text() if path.exists() else None
+    charmcraft_version = subprocess.run(
+        ["charmcraft", "version"], check=True, capture_output=True, text=True
+    ).stdout.strip()
+    inputs = {
+        "files": files,
+        "parts": charmcraft_yaml.get("parts"),
+        "base": base.name,
+        "charmcraft_version": charmcraft_version,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _extract_release_archive(
+    charm_ref: charm.CharmRef,
+    *,
+    base: collect_bases.Base,
+    session: requests.Session,
+    release_: dict,
+    charmcraft_cache_directory: pathlib.Path,
+):
+    """Download archive for charm base from release & extract into charmcraft cache directory
+
+    Returns `False` if release does not contain an archive for charm base
+    """
+    archive_name = release.archive_name_without_extension(
+        charm_ref, base_name_in_artifact=base.name_in_artifact
+    )
+    # Includes archives of previous releases listed in release's archive manifest
+    archives = release.available_archives(session, release_)
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        # Release may use any archive format
+        for extension in dict.fromkeys(release.ARCHIVE_EXTENSIONS.values()):
+            archive_path = pathlib.Path(temporary_directory, f"{archive_name}{extension}")
+            if archive_path.name in archives:
+                github.download(session, archives[archive_path.name], path=archive_path)
+                break
+        else:
+            return False
+        release.extract_archive(
+            archive_path, charmcraft_cache_directory / _CHARMCRAFT_BASE_CACHE_DIRECTORY_NAME
+        )
+    print(f'[ccc-hub] Extracted {archive_path.name} from release {release_["name"]}', flush=True)
+    return True
+
+
+def _seed_from_release(
+    charm_ref: charm.CharmRef,
+    *,
+    base: collect_bases.Base,
+    session: requests.Session,
+    release_: dict,
+    charmcraft_cache_directory: pathlib.Path,
+    requirements: set,
+):
+    """Copy wheels of requirements from release archive for charm base into pip cache directory
+
+    The release archive contains the wheels of every ref of the charm (& of previous releases);
+    only wheels of current requirements are copied so that the next release archive does not
+    keep every wheel version
+
+    Returns `False` if release does not contain an archive for charm base
+    """
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        release_cache_directory = pathlib.Path(temporary_directory)
+        if not _extract_release_archive(
+            charm_ref,
+            base=base,
+            session=session,
+            release_=release_,
+            charmcraft_cache_directory=release_cache_directory,
+        ):
+            return False
+        wheelhouse.seed(
+            _pip_cache_directory(charmcraft_cache_directory, base=base),
+            wheelhouse_directory=_pip_cache_directory(release_cache_directory, base=base)
+            / "wheels",
+            requirements=requirements,
+            source=f'release {release_["name"]}',
+        )
+    return True
+
+
+def _dependencies_unchanged(
+    charm_ref: charm.CharmRef,
+    *,
+    base: collect_bases.Base,
+    dependency_hash: str,
+    session: requests.Session,
+    release_: dict,
+):
+    """Check if release contains an archive for charm base built with the same dependency hash"""
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        dependency_hashes_path = pathlib.Path(temporary_directory, "dependency-hashes.json")
+        if not github.download_asset(
+            session, release_, name=dependency_hashes_path.name, path=dependency_hashes_path
+        ):
+            return False
+        dependency_hashes = json.loads(dependency_hashes_path.read_text())
+    for entry in dependency_hashes:
+        # Any ref of the same charm; release archives contain the wheels of every ref
+        if (
+            entry["github_repository"] == charm_ref.github_repository
+            and entry["relative_path_to_charmcraft_yaml"]
+            == charm_ref.relative_path_to_charmcraft_yaml
+            and entry["base_name_in_artifact"] == base.name_in_artifact
+            and entry["dependency_hash"] == dependency_hash
+        ):
+            return True
+    return False
+
+
+def _pip_cache_directory(charmcraft_cache_directory: pathlib.Path, *, base: collect_bases.Base):
+    """pip cache directory used by charmcraft 2 for base"""
+    # Example `base.name`: "ubuntu@22.04:amd64"
+    channel = base.name.removeprefix("ubuntu@").split(":")[0]
+    return (
+        charmcraft_cache_directory
+        / _CHARMCRAFT_BASE_CACHE_DIRECTORY_NAME
+        / _CHARMCRAFT_BASE_ALIASES[channel]
+        / "pip"
+    )
+
+
+def _wheels_only_unsupported(charmcraft_yaml: dict):
+    """Keys of charm part that `_build_wheels` does not reproduce"""
+    charm_part = charmcraft_yaml.get("parts", {}).get("charm", {})
+    unsupported = sorted(set(charm_part) - _WHEELS_ONLY_CHARM_PART_KEYS)
+    if charm_part.get("plugin", "charm") != "charm":
+        unsupported.append(f'plugin: {charm_part["plugin"]}')
+    return unsupported
+
+
+def _build_wheels(
+    charm_dir: pathlib.Path,
+    *,
+    charmcraft_yaml: dict,
+    base: collect_bases.Base,
+    charmcraft_cache_directory: pathlib.Path,
+    timer: timing.Timer,
+):
+    """Build wheels of charm dependencies without packing charm
+
+    Runs the same pip commands as the charmcraft 2 charm plugin in an LXD container of the same
+    Ubuntu version, with the same pip cache directory mounted, so that the pip cache contains the
+    same wheels as after `charmcraft pack`
+
+    Only use if `_wheels_only_unsupported` is empty
+
+    https://github.com/canonical/charmcraft/blob/2.7.1/charmcraft/parts/plugins/_charm.py
+    """
+    charm_part = charmcraft_yaml.get("parts", {}).get("charm", {})
+    requirements_files = charm_part.get("charm-requirements", ["requirements.txt"])
+    with lxd.instance(
+        base,
+        # Unique for each concurrent build
+        name=f"ccchub-wheels-{os.getpid()}-{threading.get_native_id()}",
+        pip_cache_directory=_pip_cache_directory(charmcraft_cache_directory, base=base),
+        build_packages=charm_part.get("build-packages", []),
+        timer=timer,
+    ) as instance:
+        for requirements_file in requirements_files:
+            subprocess.run(
+                [
+                    "lxc",
+                    "file",
+                    "push",
+                    "--create-dirs",
+                    str(charm_dir / requirements_file),
+                    f"{instance}/root/{requirements_file}",
+                ],
+                check=True,
+            )
+        pip_install = [lxd.PIP, "install"]
+        if charm_part.get("charm-strict-dependencies"):
+            pip_install.append("--no-deps")
+        commands = []
+        if binary_packages := charm_part.get("charm-binary-python-packages"):
+            commands.append([*pip_install, *binary_packages])
+        if python_packages := charm_part.get("charm-python-packages"):
+            commands.append([*pip_install, "--no-binary=:all:", *python_packages])
+        commands.append(
+            [
+                *pip_install,
+                "--no-binary=:all:",
+                *(f"--requirement={requirements_file}" for requirements_file in requirements_files),
+            ]
+        )
+        for command in commands:
+            lxd.run(instance, command, timer=timer, phase="dependency install")
+    print(f"[ccc-hub] Built wheels for {base.name}", flush=True)
+
+
+def _write_build_report(
+    charm_ref: charm.CharmRef, *, base: collect_bases.Base, name: str, timer: timing.Timer
+):
+    """Write time spent in each build phase & building each wheel from source"""
+    report = timer.report()
+    path = pathlib.Path(f"~/charmcraftcache-hub-ci/build-reports/{name}.json").expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(
+            {
+                "github_repository": charm_ref.github_repository,
+                "ref": charm_ref.ref,
+                "relative_path_to_charmcraft_yaml": charm_ref.relative_path_to_charmcraft_yaml,
+                "base_name_in_artifact": base.name_in_artifact,
+                **report,
+            },
+            indent=2,
+        )
+    )
+    slowest = ", ".join(
+        f"{package} ({seconds}s)" for package, seconds in list(report["wheels"].items())[:5]
+    )
+    print(
+        f'[ccc-hub] {base.name} build took {report["total_seconds"]}s. Phases: {report["phases"]}. '
+        f"Slowest wheels: {slowest or None}",
+        flush=True,
+    )
+
+
+def _build(
+    charm_ref: charm.CharmRef,
+    *,
+    charm_dir: pathlib.Path,
+    charmcraft_yaml: dict,
+    base: collect_bases.Base,
+    name: str,
+    session: requests.Session | None,
+    latest_release: dict | None,
+    reuse_previous_release: bool,
+    seed_from_previous_release: bool,
+    wheelhouse_directory: pathlib.Path | None,
+    wheels_only: bool,
+):
+    """Build charm base with separate charmcraft cache directory for base
+
+    `name` is used for the charmcraft cache directory, dependency hash & build report of the build
+    """
+    timer = timing.Timer()
+    # Build report is written for failed & interrupted (e.g. at job timeout) builds too
+    try:
+        # Cache directory used by charmcraft; unrelated to charmcraftcache CLI
+        charmcraft_cache_directory = pathlib.Path(
+            f"~/charmcraftcache-hub-ci/charmcraft-cache/{name}"
+        ).expanduser()
+
+        charmcraft_cache_directory.mkdir(parents=True)
+        dependency_hash = _dependency_hash(charm_dir, charmcraft_yaml=charmcraft_yaml, base=base)
+        # Included in release so that next build can check if dependencies changed
+        dependency_hash_path = pathlib.Path(
+            f"~/charmcraftcache-hub-ci/dependency-hashes/{name}.json"
+        ).expanduser()
+        dependency_hash_path.parent.mkdir(parents=True, exist_ok=True)
+        dependency_hash_path.write_text(
+            json.dumps(
+                {
+                    "github_repository": charm_ref.github_repository,
+                    "ref": charm_ref.ref,
+                    "relative_path_to_charmcraft_yaml": charm_ref.relative_path_to_charmcraft_yaml,
+                    "base_name_in_artifact": base.name_in_artifact,
+                    "dependency_hash": dependency_hash,
+                }
+            )
+        )
+        print(f"[ccc-hub] {base.name} dependency hash {dependency_hash}", flush=True)
+        # Pinned requirements that are built from source
+        requirements = wheelhouse.source_requirements(
+            charmcraft_yaml,
+            read_file=lambda path: (
+                (charm_dir / path).read_text() if (charm_dir / path).exists() else None
+            ),
+        )
+        if latest_release and reuse_previous_release:
+            with timer.phase("previous release"):
+                unchanged = _dependencies_unchanged(
+                    charm_ref,
+                    base=base,
+                    dependency_hash=dependency_hash,
+                    session=session,
+                    release_=latest_release,
+                ) and _seed_from_release(
+                    charm_ref,
+                    base=base,
+                    session=session,
+                    release_=latest_release,
+                    charmcraft_cache_directory=charmcraft_cache_directory,
+                    requirements=requirements,
+                )
+            if unchanged:
+                print(
+                    f"[ccc-hub] {base.name} dependencies unchanged since latest release. Skipped build",
+                    flush=True,
+                )
+                return
+            print(f"[ccc-hub] {base.name} dependencies changed since latest release", flush=True)
+        if latest_release and seed_from_previous_release:
+            # Only new or changed packages will be built from source
+            with timer.phase("previous release"):
+                _seed_from_release(
+                    charm_ref,
+                    base=base,
+                    session=session,
+                    release_=latest_release,
+                    charmcraft_cache_directory=charmcraft_cache_directory,
+                    requirements=requirements,
+                )
+        # Example: "wheelhouse-base-ubuntu@22.04_ccchubbase_amd64" (GitHub Actions artifact)
+        base_wheelhouse_directory = (
+            wheelhouse_directory / f"wheelhouse-base-{base.name_in_artifact}"
+            if wheelhouse_directory
+            else None
+        )
+        if base_wheelhouse_directory and base_wheelhouse_directory.exists():
+            # Only packages that the shared wheelhouse failed to build will be built from source
+            with timer.phase("wheelhouse"):
+                wheelhouse.seed(
+                    _pip_cache_directory(charmcraft_cache_directory, base=base),
+                    wheelhouse_directory=base_wheelhouse_directory,
+                    requirements=requirements,
+                )
+        if wheels_only and (unsupported := _wheels_only_unsupported(charmcraft_yaml)):
+            print(
+                f"[ccc-hub] {base.name} charm part uses {unsupported}, which wheels-only mode does not "
+                "reproduce. Packing with charmcraft",
+                flush=True,
+            )
+            wheels_only = False
+        if wheels_only:
+            _build_wheels(
+                charm_dir,
+                charmcraft_yaml=charmcraft_yaml,
+                base=base,
+                charmcraft_cache_directory=charmcraft_cache_directory,
+                timer=timer,
+            )
+        else:
+            timer.run(
+                ["charmcraft", "pack", "-v", "--bases-index", str(base.base_index)],
+                phase="charmcraft",
+                cwd=charm_dir,
+                env={**os.environ, "CRAFT_SHARED_CACHE": str(charmcraft_cache_directory)},
+            )
+        print(f"[ccc-hub] Built {base.name}", flush=True)
+    finally:
+        _write_build_report(charm_ref, base=base, name=name, timer=timer)
+
+
+def _bases(
+    charmcraft_yaml: dict, *, base_indexes: list[int] | None, architecture: str | None
+) -> list[collect_bases.Base]:
+    """Bases to build (by index in charmcraft.yaml or all bases for architecture)"""
+    if base_indexes is None:
+        base_indexes = [
+            index
+            for index, base in enumerate(charmcraft_yaml["bases"])
+            if collect_bases.build_on_architecture(base) == architecture
+        ]
+        assert base_indexes, f"No bases in charmcraft.yaml for {architecture=}"
+    return [
+        collect_bases.Base.from_charmcraft_yaml_base(
+            charmcraft_yaml["bases"][index], base_index=index
+        )
+        for index in base_indexes
+    ]
 
 
 def main():
-    """Build charm base"""
+    """Build charm bases
+
+    With `--group`, build multiple charms in the same GitHub repository from one checkout
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument("--github-repository", required=True)
-    parser.add_argument("--ref", required=True)
-    parser.add_argument("--relative-path-to-charmcraft-yaml", required=True)
-    parser.add_argument("--base-index", required=True)
-    args = vars(parser.parse_args())
-    base_index = args.pop("base_index")
-    charm_ref = charm.CharmRef(**args)
-    charm_dir = checkout.checkout(charm_ref, sparse=False)
-    # Cache directory used by charmcraft; unrelated to charmcraftcache CLI
-    charmcraft_cache_directory = pathlib.Path(
-        "~/charmcraftcache-hub-ci/charmcraft-cache"
-    ).expanduser()
-
-    charmcraft_cache_directory.mkdir(parents=True)
-    env = os.environ
-    env["CRAFT_SHARED_CACHE"] = str(charmcraft_cache_directory)
-    requirements = pathlib.Path(charm_dir, "requirements.txt")
-    if not requirements.exists():
-        # Workaround for https://github.com/canonical/charmcraft/issues/1389 on charmcraft 2
-        requirements.touch()
-    subprocess.run(
-        ["charmcraft", "pack", "-v", "--bases-index", base_index],
-        cwd=charm_dir,
-        check=True,
-        env=env,
+    parser.add_argument("--ref")
+    parser.add_argument("--relative-path-to-charmcraft-yaml")
+    parser.add_argument(
+        "--group",
+        help="JSON list of charms in GitHub repository to build instead of --ref & "
+        "--relative-path-to-charmcraft-yaml. Each item has 'ref', "
+        "'relative_path_to_charmcraft_yaml', 'charm_index' & (optional) 'base_indexes' keys",
+    )
+    bases_group = parser.add_mutually_exclusive_group()
+    bases_group.add_argument(
+        "--base-index", type=int, nargs="+", help="Indexes of bases in charmcraft.yaml"
+    )
+    bases_group.add_argument(
+        "--architecture", help="Build all bases in charmcraft.yaml for architecture (e.g. amd64)"
+    )
+    parser.add_argument("--jobs", type=int, default=1, help="Maximum bases built concurrently")
+    parser.add_argument(
+        "--git-mirror-directory", help="Directory with persistent bare mirrors of git repositories"
+    )
+    parser.add_argument(
+        "--reuse-previous-release",
+        action="store_true",
+        help="Skip `charmcraft pack` if dependencies unchanged since latest release",
+    )
+    parser.add_argument(
+        "--seed-from-previous-release",
+        action="store_true",
+        help="Extract wheels from latest release into charmcraft cache before `charmcraft pack`",
+    )
+    parser.add_argument(
+        "--wheelhouse-directory",
+        help="Directory with shared wheelhouse of each base (from `build-wheelhouse`) in "
+        "'wheelhouse-base-<base name in artifact>' directories",
+    )
+    parser.add_argument(
+        "--wheels-only",
+        action="store_true",
+        help="Only build wheels of charm dependencies (skip packing .charm file). Falls back to "
+        "charmcraft for charms with a charm part that cannot be reproduced",
     )
+    args = parser.parse_args()
+    git_mirror_directory = args.git_mirror_directory
+    if git_mirror_directory:
+        git_mirror_directory = pathlib.Path(git_mirror_directory).expanduser()
+    wheelhouse_directory = args.wheelhouse_directory
+    if wheelhouse_directory:
+        wheelhouse_directory = pathlib.Path(wheelhouse_directory).expanduser()
+    # (Charm ref, base indexes, prefix of build name)
+    charms: list[tuple[charm.CharmRef, list[int] | None, str]] = []
+    if args.group:
+        if args.ref or args.relative_path_to_charmcraft_yaml:
+            parser.error("--group cannot be used with --ref or --relative-path-to-charmcraft-yaml")
+        for item in json.loads(args.group):
+            charm_ref = charm.CharmRef(
+                github_repository=args.github_repository,
+                ref=item["ref"],
+                relative_path_to_charmcraft_yaml=item["relative_path_to_charmcraft_yaml"],
+            )
+            base_indexes = item.get("base_indexes", args.base_index)
+            if base_indexes is None and args.architecture is None:
+                parser.error("--architecture required if 'base_indexes' missing from --group")
+            # Example build name: "charm-0-base-ubuntu@22.04_ccchubbase_amd64"
+            charms.append((charm_ref, base_indexes, f'charm-{item["charm_index"]}-base-'))
+    else:
+        if not (args.ref and args.relative_path_to_charmcraft_yaml):
+            parser.error("--ref & --relative-path-to-charmcraft-yaml required without --group")
+        if args.base_index is None and args.architecture is None:
+            parser.error("--base-index or --architecture required without --group")
+        charm_ref = charm.CharmRef(
+            github_repository=args.github_repository,
+            ref=args.ref,
+            relative_path_to_charmcraft_yaml=args.relative_path_to_charmcraft_yaml,
+        )
+        # Example build name: "ubuntu@22.04_ccchubbase_amd64"
+        charms.append((charm_ref, args.base_index, ""))
+    session = None
+    latest_release = None
+    if args.reuse_previous_release or args.seed_from_previous_release:
+        session = github.session()
+        latest_release = github.latest_release(session)
+    with contextlib.ExitStack() as stack:
+        if args.group:
+            # One fetch of each ref for all charms
+            charm_dirs = stack.enter_context(
+                checkout.worktrees(
+                    [charm_ref for charm_ref, _, _ in charms],
+                    directories=[
+                        pathlib.Path(f"charm-repos/{index}") for index in range(len(charms))
+                    ],
+                    mirror_directory=git_mirror_directory,
+                )
+            )
+        else:
+            charm_dirs = [
+                checkout.checkout(charms[0][0], sparse=False, mirror_directory=git_mirror_directory)
+            ]
+        builds = []
+        for (charm_ref, base_indexes, prefix), charm_dir in zip(charms, charm_dirs):
+            charmcraft_yaml = yaml.safe_load((charm_dir / "charmcraft.yaml").read_text())
+            requirements = pathlib.Path(charm_dir, "requirements.txt")
+            if not requirements.exists():
+                # Workaround for https://github.com/canonical/charmcraft/issues/1389 on charmcraft 2
+                requirements.touch()
+            for base in _bases(
+                charmcraft_yaml, base_indexes=base_indexes, architecture=args.architecture
+            ):
+                builds.append(
+                    functools.partial(
+                        _build,
+                        charm_ref,
+                        charm_dir=charm_dir,
+                        charmcraft_yaml=charmcraft_yaml,
+                        base=base,
+                        name=f"{prefix}{base.name_in_artifact}",
+                        session=session,
+                        latest_release=latest_release,
+                        reuse_previous_release=args.reuse_previous_release,
+                        seed_from_previous_release=args.seed_from_previous_release,
+                        wheelhouse_directory=wheelhouse_directory,
+                        wheels_only=args.wheels_only,
+                    )
+                )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(build) for build in builds]
+            for future in futures:
+                # Raise exception if build failed
+                future.result()
@@ -6,3 +6,9 @@ class CharmRef:
     github_repository: str
     ref: str
     relative_path_to_charmcraft_yaml: str
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class ResolvedCharmRef(CharmRef):
+    commit: str
+    """Commit sha that `ref` resolved to"""
@@ -1,28 +1,132 @@
+import contextlib
 import functools
+import os
 import pathlib
 import subprocess
+import tempfile
 
 from . import charm
 
 _REPOSITORY_DIRECTORY = pathlib.Path("charm-repo")
-_run = functools.partial(
-    subprocess.run, cwd=_REPOSITORY_DIRECTORY, check=True, capture_output=True, text=True
-)
+_run = functools.partial(subprocess.run, check=True, capture_output=True, text=True)
 
 
 class CharmNotFound(Exception):
     """Charm repository or ref not found"""
 
 
-def checkout(charm_ref: charm.CharmRef, *, sparse=True):
+def _mirror_path(github_repository: str, *, mirror_directory: pathlib.Path):
+    # Example: "canonical_kfp-operators.git"
+    return mirror_directory / f'{github_repository.replace("/", "_")}.git'
+
+
+def _add_origin(charm_ref: charm.CharmRef, *, cwd: pathlib.Path):
+    _run(
+        ["git", "remote", "add", "origin", f"https://github.com/{charm_ref.github_repository}.git"],
+        cwd=cwd,
+    )
+
+
+def _fetch(charm_ref: charm.CharmRef, *, cwd: pathlib.Path, blob_filter=False):
+    """Fetch only the commit that ref points to (no history, no tags, no other branches)
+
+    If `blob_filter`, file contents are not fetched until they are checked out
+
+    Returns commit sha of ref
+
+    Raises `CharmNotFound`
+    """
+    command = ["git", "fetch", "--depth=1", "--no-tags"]
+    if blob_filter:
+        command.append("--filter=blob:none")
+    try:
+        _run([*command, "origin", charm_ref.ref], cwd=cwd)
+    except subprocess.CalledProcessError as exception:
+        if "ERROR: Repository not found." in exception.stderr:
+            raise CharmNotFound(f"{charm_ref.github_repository=} not found")
+        elif "couldn't find remote ref" in exception.stderr:
+            raise CharmNotFound(f"{charm_ref.ref=} not found")
+        else:
+            raise
+    return _run(["git", "rev-parse", "FETCH_HEAD^{commit}"], cwd=cwd).stdout.strip()
+
+
+def _object_store_size(*, cwd: pathlib.Path):
+    """Number of objects & size in KiB of repository object store
+
+    (Does not include objects borrowed from alternates)
+    """
+    # https://git-scm.com/docs/git-count-objects#_options
+    output = _run(["git", "count-objects", "--verbose"], cwd=cwd).stdout
+    counts = {key: int(value) for key, value in (line.split(": ") for line in output.splitlines())}
+    return counts["count"] + counts["in-pack"], counts["size"] + counts["size-pack"]
+
+
+def _init_bare_repository(charm_ref: charm.CharmRef, *, repository: pathlib.Path):
+    repository.mkdir(parents=True, exist_ok=True)
+    _run(["git", "init", "--bare"], cwd=repository)
+    _add_origin(charm_ref, cwd=repository)
+
+
+def _update_bare_repository(charm_ref: charm.CharmRef, *, repository: pathlib.Path):
+    """Fetch ref into bare repository
+
+    Only objects missing from the repository are transferred
+
+    Returns commit sha of ref
+
+    Raises `CharmNotFound`
+    """
+    objects_before, kib_before = _object_store_size(cwd=repository)
+    # Do not filter blobs: checkouts that borrow objects from the repository cannot lazily fetch
+    # missing blobs
+    commit = _fetch(charm_ref, cwd=repository)
+    # Keep a ref to the commit so that objects are not pruned by `git gc` and so that the next
+    # fetch of this ref can negotiate with the objects already in the repository
+    _run(["git", "update-ref", f"refs/ccchub/{charm_ref.ref}", commit], cwd=repository)
+    objects_after, kib_after = _object_store_size(cwd=repository)
+    print(
+        f"[ccc-hub] Updated {repository.name} to {commit=}. Fetched "
+        f"{objects_after - objects_before} objects ({kib_after - kib_before} KiB)",
+        flush=True,
+    )
+    return commit
+
+
+def _update_mirror(charm_ref: charm.CharmRef, *, mirror_directory: pathlib.Path):
+    """Fetch ref into bare mirror repository (one mirror per GitHub repository)
+
+    Only objects missing from the mirror are transferred
+
+    Returns path to mirror & commit sha of ref
+
+    Raises `CharmNotFound`
+    """
+    mirror = _mirror_path(charm_ref.github_repository, mirror_directory=mirror_directory)
+    if not mirror.exists():
+        _init_bare_repository(charm_ref, repository=mirror)
+    return mirror, _update_bare_repository(charm_ref, repository=mirror)
+
+
+def checkout(
+    charm_ref: charm.CharmRef,
+    *,
+    sparse=True,
+    mirror_directory: pathlib.Path | None = None,
+):
     """Checkout charm
 
+    Only the commit that the ref points to is fetched
+
+    If `mirror_directory` is set, objects are fetched into a persistent bare mirror of the
+    repository in that directory & the checkout borrows objects from the mirror
+
     Returns path to charm directory
 
     Raises `CharmNotFound`
     """
     _REPOSITORY_DIRECTORY.mkdir()
-    _run(["git", "init"])
+    _run(["git", "init"], cwd=_REPOSITORY_DIRECTORY)
     if sparse:
         _run(
             [
@@ -31,33 +135,145 @@ def checkout(charm_ref: charm.CharmRef, *, sparse=True):
                 "set",
                 "--sparse-index",
                 charm_ref.relative_path_to_charmcraft_yaml,
-            ]
+            ],
+            cwd=_REPOSITORY_DIRECTORY,
         )
-    try:
-        _run(
-            [
-                "git",
-                "remote",
-                "add",
-                "--fetch",
-                "origin",
-                f"https://github.com/{charm_ref.github_repository}.git",
-            ]
+    if mirror_directory:
+        mirror, commit = _update_mirror(charm_ref, mirror_directory=mirror_directory)
+        # https://git-scm.com/docs/gitrepository-layout#Documentation/gitrepository-layout.txt-objectsinfoalternates
+        pathlib.Path(_REPOSITORY_DIRECTORY, ".git/objects/info/alternates").write_text(
+            f'{(mirror / "objects").resolve()}\n'
         )
-    except subprocess.CalledProcessError as exception:
-        if "ERROR: Repository not found." in exception.stderr:
-            raise CharmNotFound(f"{charm_ref.github_repository=} not found")
-        else:
-            raise
-    try:
-        _run(["git", "fetch", "origin", charm_ref.ref])
-    except subprocess.CalledProcessError as exception:
-        if "couldn't find remote ref" in exception.stderr:
-            raise CharmNotFound(f"{charm_ref.ref=} not found")
-        else:
-            raise
-    _run(["git", "checkout", "FETCH_HEAD"])
+    else:
+        _add_origin(charm_ref, cwd=_REPOSITORY_DIRECTORY)
+        commit = _fetch(charm_ref, cwd=_REPOSITORY_DIRECTORY)
+    _run(["git", "checkout", commit], cwd=_REPOSITORY_DIRECTORY)
+    if not mirror_directory:
+        objects, kib = _object_store_size(cwd=_REPOSITORY_DIRECTORY)
+        print(f"[ccc-hub] Fetched {objects} objects ({kib} KiB)", flush=True)
     path = _REPOSITORY_DIRECTORY / charm_ref.relative_path_to_charmcraft_yaml
     assert path.resolve().is_relative_to(_REPOSITORY_DIRECTORY.resolve())
-    print(f"[ccc-hub] Checked out {charm_ref=}", flush=True)
+    print(f"[ccc-hub] Checked out {charm_ref=} at {commit=}", flush=True)
     return path
+
+
+@contextlib.contextmanager
+def worktrees(
+    charm_refs: list[charm.CharmRef],
+    *,
+    directories: list[pathlib.Path],
+    mirror_directory: pathlib.Path | None = None,
+):
+    """Checkout multiple refs/paths of the same repository into separate git worktrees
+
+    The worktrees share one object store (a persistent bare mirror of the repository in
+    `mirror_directory` if set, otherwise a temporary bare repository) & each ref is fetched once
+
+    `charm_refs[i]` is checked out into `directories[i]`. Directories must not exist or be empty
+
+    Yields paths to charm directories (in the same order as `charm_refs`)
+
+    Worktrees (& temporary bare repository) are removed on exit
+
+    Raises `CharmNotFound`
+    """
+    assert len(charm_refs) == len(directories)
+    assert len({charm_ref.github_repository for charm_ref in charm_refs}) == 1
+    with contextlib.ExitStack() as stack:
+        # Ref: commit
+        commits: dict[str, str] = {}
+        if mirror_directory:
+            for charm_ref in charm_refs:
+                if charm_ref.ref not in commits:
+                    repository, commits[charm_ref.ref] = _update_mirror(
+                        charm_ref, mirror_directory=mirror_directory
+                    )
+            # Remove metadata of worktrees that were not cleaned up (e.g. process killed)
+            _run(["git", "worktree", "prune"], cwd=repository)
+        else:
+            repository = pathlib.Path(stack.enter_context(tempfile.TemporaryDirectory()))
+            _init_bare_repository(charm_refs[0], repository=repository)
+            for charm_ref in charm_refs:
+                if charm_ref.ref not in commits:
+                    commits[charm_ref.ref] = _update_bare_repository(
+                        charm_ref, repository=repository
+                    )
+        paths = []
+        for charm_ref, directory in zip(charm_refs, directories):
+            directory = directory.resolve()
+            _run(
+                ["git", "worktree", "add", "--detach", str(directory), commits[charm_ref.ref]],
+                cwd=repository,
+            )
+            stack.callback(
+                _run, ["git", "worktree", "remove", "--force", str(directory)], cwd=repository
+            )
+            path = directory / charm_ref.relative_path_to_charmcraft_yaml
+            assert path.resolve().is_relative_to(directory)
+            print(f"[ccc-hub] Checked out {charm_ref=} to {directory}", flush=True)
+            paths.append(path)
+        yield paths
+    print(f"[ccc-hub] Removed {len(directories)} worktrees", flush=True)
+
+
+@contextlib.contextmanager
+def file_reader(charm_ref: charm.CharmRef, *, mirror_directory: pathlib.Path | None = None):
+    """Fetch ref once to read multiple files in charm directory without checking out a working tree
+
+    Only the commit & trees that the ref points to and the blobs of files that are read are fetched
+
+    If `mirror_directory` is set, files are read from a persistent bare mirror of the repository in
+    that directory
+
+    Yields function that takes a path relative to charm directory (e.g. "charmcraft.yaml") &
+    returns file contents (raises `CharmNotFound` if file does not exist)
+
+    Raises `CharmNotFound`
+    """
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        if mirror_directory:
+            repository, commit = _update_mirror(charm_ref, mirror_directory=mirror_directory)
+        else:
+            repository = pathlib.Path(temporary_directory)
+            _run(["git", "init", "--bare"], cwd=repository)
+            _add_origin(charm_ref, cwd=repository)
+            commit = _fetch(charm_ref, cwd=repository, blob_filter=True)
+
+        def read(path: str):
+            # `os.path.normpath` since "<commit>:./<path>" is relative to the working directory
+            path = os.path.normpath(
+                pathlib.PurePosixPath(charm_ref.relative_path_to_charmcraft_yaml, path)
+            )
+            assert not path.startswith("../")
+            try:
+                # Blob is lazily fetched from (promisor) remote
+                contents = _run(
+                    ["git", "cat-file", "blob", f"{commit}:{path}"], cwd=repository
+                ).stdout
+            except subprocess.CalledProcessError as exception:
+                if "does not exist" in exception.stderr:
+                    raise CharmNotFound(f"{path=} not found at {commit=}")
+                else:
+                    raise
+            print(f"[ccc-hub] Read {path} from {charm_ref=} at {commit=}", flush=True)
+            return contents
+
+        yield read
+        if not mirror_directory:
+            objects, kib = _object_store_size(cwd=repository)
+            print(f"[ccc-hub] Fetched {objects} objects ({kib} KiB)", flush=True)
+
+
+def read_file(
+    charm_ref: charm.CharmRef, path: str, *, mirror_directory: pathlib.Path | None = None
+):
+    """Read one file in charm directory without checking out a working tree
+
+    `path` is relative to charm directory (e.g. "charmcraft.yaml")
+
+    Returns file contents
+
+    Raises `CharmNotFound`
+    """
+    with file_reader(charm_ref, mirror_directory=mirror_directory) as read:
+        return read(path)
@@ -1,4 +1,5 @@
 import argparse
+import concurrent.futures
 import dataclasses
 import enum
 import json
@@ -7,7 +8,7 @@ import pathlib
 
 import yaml
 
-from . import charm, checkout
+from . import charm, checkout, lock
 
 
 class _Architecture(str, enum.Enum):
@@ -21,6 +22,28 @@ _RUNNERS = {
 }
 
 
+def _build_on(base: dict):
+    # https://discourse.charmhub.io/t/charmcraft-bases-provider-support/4713
+    build_on = base.get("build-on")
+    if build_on:
+        assert isinstance(build_on, list) and len(build_on) == 1
+        return build_on[0]
+    return base
+
+
+def build_on_architecture(base: dict) -> str:
+    """Architecture that charmcraft.yaml base builds on (e.g. "amd64")"""
+    build_on_architectures = _build_on(base).get("architectures")
+    if build_on_architectures:
+        assert len(build_on_architectures) == 1, (
+            f"Multiple architectures ({build_on_architectures}) in one (charmcraft.yaml) base "
+            "entry not supported. Use one entry per architecture"
+        )
+        return _Architecture(build_on_architectures[0]).value
+    # Default to X64
+    return _Architecture.X64.value
+
+
 @dataclasses.dataclass(frozen=True, kw_only=True)
 class Base:
     base_index: int
@@ -47,21 +70,8 @@ class Base:
 
     @classmethod
     def from_charmcraft_yaml_base(cls, base: dict, *, base_index: int):
-        # https://discourse.charmhub.io/t/charmcraft-bases-provider-support/4713
-        build_on = base.get("build-on")
-        if build_on:
-            assert isinstance(build_on, list) and len(build_on) == 1
-            base = build_on[0]
-        build_on_architectures = base.get("architectures")
-        if build_on_architectures:
-            assert len(build_on_architectures) == 1, (
-                f"Multiple architectures ({build_on_architectures}) in one (charmcraft.yaml) base "
-                "entry not supported. Use one entry per architecture"
-            )
-            architecture = _Architecture(build_on_architectures[0])
-        else:
-            # Default to X64
-            architecture = _Architecture.X64
+        architecture = _Architecture(build_on_architecture(base))
+        base = _build_on(base)
         assert base["name"] == "ubuntu"
         return cls(
             base_index=base_index,
@@ -71,20 +81,136 @@ class Base:
         )
 
 
+def _charmcraft_yaml_bases(
+    charm_ref: charm.CharmRef, *, mirror_directory: pathlib.Path | None = None
+) -> list[dict]:
+    """'bases' of charmcraft.yaml"""
+    charmcraft_yaml = yaml.safe_load(
+        checkout.read_file(charm_ref, "charmcraft.yaml", mirror_directory=mirror_directory)
+    )
+    return charmcraft_yaml["bases"]
+
+
+def _bases(charmcraft_yaml_bases: list[dict]):
+    return [
+        Base.from_charmcraft_yaml_base(base, base_index=index)
+        for index, base in enumerate(charmcraft_yaml_bases)
+    ]
+
+
+def _collect(charm_ref: charm.CharmRef, *, mirror_directory: pathlib.Path | None = None):
+    return _bases(_charmcraft_yaml_bases(charm_ref, mirror_directory=mirror_directory))
+
+
+# (GitHub repository, commit sha, relative path to charmcraft.yaml)
+_CacheKey = tuple[str, str, str]
+
+
+def _read_cache(path: pathlib.Path) -> dict[_CacheKey, list[dict]]:
+    """Read 'bases' of charmcraft.yaml by commit
+
+    `Base`s are not cached so that changes to `Base` (e.g. runners) apply to cached commits.
+    Entries from older versions of the cache (without "charmcraft_yaml_bases") are ignored
+    """
+    if not path.exists():
+        return {}
+    return {
+        (
+            entry["github_repository"],
+            entry["commit"],
+            entry["relative_path_to_charmcraft_yaml"],
+        ): entry["charmcraft_yaml_bases"]
+        for entry in json.loads(path.read_text())
+        if "charmcraft_yaml_bases" in entry
+    }
+
+
+def _write_cache(path: pathlib.Path, cache: dict[_CacheKey, list[dict]]):
+    path.write_text(
+        json.dumps(
+            [
+                {
+                    "github_repository": github_repository,
+                    "commit": commit,
+                    "relative_path_to_charmcraft_yaml": relative_path_to_charmcraft_yaml,
+                    "charmcraft_yaml_bases": charmcraft_yaml_bases,
+                }
+                for (
+                    github_repository,
+                    commit,
+                    relative_path_to_charmcraft_yaml,
+                ), charmcraft_yaml_bases in cache.items()
+            ],
+            indent=2,
+        )
+    )
+
+
+def _resolve(charm_refs: list[charm.CharmRef], *, max_workers: int):
+    """Resolve refs that are not already resolved"""
+    if all(isinstance(charm_ref, charm.ResolvedCharmRef) for charm_ref in charm_refs):
+        return charm_refs
+    return lock.resolve(charm_refs, max_workers=max_workers)
+
+
+def collect(
+    charm_refs: list[charm.CharmRef], *, max_workers: int, cache_path: pathlib.Path | None = None
+):
+    """Collect bases to build from charmcraft.yaml of multiple charms concurrently
+
+    If `cache_path` is set, refs are resolved to commit shas & 'bases' of charmcraft.yaml are
+    cached by commit in that JSON file. charmcraft.yaml is only fetched for commits that are not
+    in the cache. Cache entries that were not used are removed. Refs that are already resolved
+    (`charm.ResolvedCharmRef`) are not resolved again
+
+    Returns bases for each charm (in the same order as `charm_refs`)
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if cache_path is None:
+            return list(executor.map(_collect, charm_refs))
+        cache = _read_cache(cache_path)
+        keys = [
+            (
+                charm_ref.github_repository,
+                charm_ref.commit,
+                charm_ref.relative_path_to_charmcraft_yaml,
+            )
+            for charm_ref in _resolve(charm_refs, max_workers=max_workers)
+        ]
+        missing_keys = [key for key in dict.fromkeys(keys) if key not in cache]
+        missing_charm_refs = (
+            charm.CharmRef(
+                github_repository=github_repository,
+                ref=commit,
+                relative_path_to_charmcraft_yaml=relative_path_to_charmcraft_yaml,
+            )
+            for github_repository, commit, relative_path_to_charmcraft_yaml in missing_keys
+        )
+        cache.update(zip(missing_keys, executor.map(_charmcraft_yaml_bases, missing_charm_refs)))
+    print(
+        f"[ccc-hub] Bases cache: {len(set(keys)) - len(missing_keys)} hits, "
+        f"{len(missing_keys)} misses",
+        flush=True,
+    )
+    _write_cache(cache_path, {key: cache[key] for key in keys})
+    return [_bases(cache[key]) for key in keys]
+
+
 def main():
     """Collect bases to build from charmcraft.yaml"""
     parser = argparse.ArgumentParser()
     parser.add_argument("--github-repository", required=True)
     parser.add_argument("--ref", required=True)
     parser.add_argument("--relative-path-to-charmcraft-yaml", required=True)
-    args = parser.parse_args()
-    charm_ref = charm.CharmRef(**vars(args))
-    charm_dir = checkout.checkout(charm_ref)
-    charmcraft_yaml = yaml.safe_load((charm_dir / "charmcraft.yaml").read_text())
-    bases = (
-        Base.from_charmcraft_yaml_base(base, base_index=index)
-        for index, base in enumerate(charmcraft_yaml["bases"])
+    parser.add_argument(
+        "--git-mirror-directory", help="Directory with persistent bare mirrors of git repositories"
     )
+    args = vars(parser.parse_args())
+    git_mirror_directory = args.pop("git_mirror_directory")
+    if git_mirror_directory:
+        git_mirror_directory = pathlib.Path(git_mirror_directory).expanduser()
+    charm_ref = charm.CharmRef(**args)
+    bases = _collect(charm_ref, mirror_directory=git_mirror_directory)
     bases = [dataclasses.asdict(base) for base in bases]
     output = f"bases={json.dumps(bases)}\n"
     print(output)
@@ -1,9 +1,12 @@
+import argparse
 import dataclasses
+import heapq
 import json
 import os
 import pathlib
+import statistics
 
-from . import charm
+from . import charm, collect_bases, lock
 
 
 @dataclasses.dataclass(frozen=True, kw_only=True)
@@ -23,17 +26,352 @@ class _CharmRefJob(charm.CharmRef):
         )
 
 
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class _CharmRefBaseJob(_CharmRefJob):
+    base: collect_bases.Base
+
+    @classmethod
+    def from_charm_ref_job(cls, job: _CharmRefJob, *, base: collect_bases.Base):
+        return cls(
+            **{
+                field.name: getattr(job, field.name)
+                for field in dataclasses.fields(job)
+                if field.name != "job_name"
+            },
+            job_name=f"{job.job_name} | {base.name}",
+            base=base,
+        )
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class _RepositoryJob:
+    """Build of multiple charms in the same GitHub repository on the same runner"""
+
+    github_repository: str
+    group_index: int
+    runner: str | list[str]
+    """GitHub Actions 'runs-on' value"""
+
+    job_name: str
+    charms: list[dict]
+    """Charms to build (`build --group` value)"""
+
+    timeout_minutes: int
+
+
+# Timeout of one charm base build
+_BUILD_TIMEOUT_MINUTES = 120
+# Charm bases in a group are built sequentially; limit group size so that timeout (scaled with
+# group size) stays within GitHub-hosted runner job limit of 360 minutes
+_MAX_CHARM_BASES_PER_GROUP = 3
+
+
+def _group_by_repository(jobs: list[_CharmRefBaseJob], *, estimates: list[float]):
+    """Group jobs with the same GitHub repository & runner into jobs of up to
+    `_MAX_CHARM_BASES_PER_GROUP` charm bases
+
+    Returns grouped jobs & estimated seconds to build each group
+    """
+    # (GitHub repository, runner): indexes in `jobs`
+    repositories: dict[tuple[str, str], list[int]] = {}
+    for index, job in enumerate(jobs):
+        repositories.setdefault((job.github_repository, json.dumps(job.base.runner)), []).append(
+            index
+        )
+    groups = [
+        (github_repository, indexes[start : start + _MAX_CHARM_BASES_PER_GROUP])
+        for (github_repository, _), indexes in repositories.items()
+        for start in range(0, len(indexes), _MAX_CHARM_BASES_PER_GROUP)
+    ]
+    group_jobs = []
+    group_estimates = []
+    for group_index, (github_repository, indexes) in enumerate(groups):
+        # Charm index: `build --group` item
+        charms: dict[int, dict] = {}
+        for job in (jobs[index] for index in indexes):
+            charms.setdefault(
+                job.charm_index,
+                {
+                    "ref": job.ref,
+                    "relative_path_to_charmcraft_yaml": job.relative_path_to_charmcraft_yaml,
+                    "charm_index": job.charm_index,
+                    "base_indexes": [],
+                },
+            )["base_indexes"].append(job.base.base_index)
+        base_names = sorted({jobs[index].base.name for index in indexes})
+        group_jobs.append(
+            _RepositoryJob(
+                github_repository=github_repository,
+                group_index=group_index,
+                runner=jobs[indexes[0]].base.runner,
+                job_name=(
+                    f'{github_repository.removeprefix("canonical/")} | {len(charms)} charms | '
+                    f'{", ".join(base_names)}'
+                ),
+                charms=list(charms.values()),
+                timeout_minutes=_BUILD_TIMEOUT_MINUTES * len(indexes),
+            )
+        )
+        group_estimates.append(sum(estimates[index] for index in indexes))
+    return group_jobs, group_estimates
+
+
+def _changed_charms(resolved_charm_refs: list[charm.ResolvedCharmRef], *, lock_path: pathlib.Path):
+    """Charms with a ref that resolves to a different commit than in lock file (or new refs)
+
+    Returns set of (GitHub repository, relative path to charmcraft.yaml)
+
+    Overwrites lock file with current commits
+    """
+    previous_commits = {
+        (
+            charm_ref.github_repository,
+            charm_ref.ref,
+            charm_ref.relative_path_to_charmcraft_yaml,
+        ): charm_ref.commit
+        for charm_ref in lock.read(lock_path)
+    }
+    lock.write(lock_path, resolved_charm_refs)
+    return {
+        (charm_ref.github_repository, charm_ref.relative_path_to_charmcraft_yaml)
+        for charm_ref in resolved_charm_refs
+        if previous_commits.get(
+            (charm_ref.github_repository, charm_ref.ref, charm_ref.relative_path_to_charmcraft_yaml)
+        )
+        != charm_ref.commit
+    }
+
+
+def _read_durations(path: pathlib.Path):
+    """Read build duration of each charm base from previous release
+
+    Returns (GitHub repository, ref, relative path to charmcraft.yaml, base name in artifact):
+    seconds
+    """
+    if not path.exists():
+        return {}
+    return {
+        (
+            entry["github_repository"],
+            entry["ref"],
+            entry["relative_path_to_charmcraft_yaml"],
+            entry["base_name_in_artifact"],
+        ): entry["seconds"]
+        for entry in json.loads(path.read_text())
+    }
+
+
+def _estimate_duration(job: _CharmRefJob, *, durations: dict, default: float):
+    """Estimated seconds to build job (all bases of charm if job is not for one base)"""
+    matching = [
+        seconds
+        for (github_repository, ref, relative_path_to_charmcraft_yaml, base_name), seconds in (
+            durations.items()
+        )
+        if github_repository == job.github_repository
+        and ref == job.ref
+        and relative_path_to_charmcraft_yaml == job.relative_path_to_charmcraft_yaml
+        and (not isinstance(job, _CharmRefBaseJob) or base_name == job.base.name_in_artifact)
+    ]
+    return sum(matching) if matching else default
+
+
+def _runner(job: _CharmRefJob | _RepositoryJob):
+    """GitHub Actions 'runs-on' value of job (JSON)"""
+    if isinstance(job, _RepositoryJob):
+        return json.dumps(job.runner)
+    if isinstance(job, _CharmRefBaseJob):
+        return json.dumps(job.base.runner)
+    # Runner of jobs without base is decided by workflow
+    return None
+
+
+def _makespan(jobs: list[tuple[str | None, float]], *, concurrency: int):
+    """Estimated seconds until all jobs finish
+
+    `jobs` is a list of (runner, seconds) in the order that jobs start. Up to `concurrency` jobs
+    run at the same time on each runner
+    """
+    # Runner: finish time of each job currently running on runner
+    running: dict[str | None, list[float]] = {}
+    for runner, seconds in jobs:
+        finish_times = running.setdefault(runner, [0.0] * concurrency)
+        # Job starts when the earliest running job finishes
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + seconds)
+    return max((max(finish_times) for finish_times in running.values()), default=0.0)
+
+
+# https://docs.github.com/en/actions/writing-workflows/choosing-what-your-workflow-does/running-variations-of-jobs-in-a-workflow#using-a-matrix-strategy
+_MAX_JOBS_PER_MATRIX = 256
+
+
+def _shard(jobs: list, *, estimates: list[float], shards: int):
+    """Split jobs into shards (one build matrix each) with balanced estimated duration
+
+    Jobs are assigned in order (longest first if sorted) to the shard with the least estimated
+    duration, then the fewest jobs. Order of jobs in each shard is kept
+
+    Returns jobs in each shard
+    """
+    if len(jobs) > shards * _MAX_JOBS_PER_MATRIX:
+        raise ValueError(
+            f"{len(jobs)} jobs do not fit in {shards} shards of {_MAX_JOBS_PER_MATRIX} jobs. "
+            "Increase number of shards (in collect-charms command & workflow)"
+        )
+    shard_jobs = [[] for _ in range(shards)]
+    shard_seconds = [0.0] * shards
+    for job, seconds in zip(jobs, estimates):
+        index = min(
+            (index for index in range(shards) if len(shard_jobs[index]) < _MAX_JOBS_PER_MATRIX),
+            key=lambda index: (shard_seconds[index], len(shard_jobs[index])),
+        )
+        shard_jobs[index].append(job)
+        shard_seconds[index] += seconds
+    return shard_jobs
+
+
 def main():
     """Collect charms to build from charms.json"""
-    charm_refs = (
-        charm.CharmRef(**charm_) for charm_ in json.loads(pathlib.Path("charms.json").read_text())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bases",
+        action="store_true",
+        help="Collect bases of every charm & output one job per charm base",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=8, help="Maximum concurrent charmcraft.yaml fetches"
+    )
+    parser.add_argument(
+        "--bases-cache", help="JSON file that caches bases by commit (created if missing)"
+    )
+    parser.add_argument(
+        "--group-by-repository",
+        action="store_true",
+        help="Output jobs that build up to "
+        f"{_MAX_CHARM_BASES_PER_GROUP} charm bases of the same GitHub repository & runner from "
+        "one checkout (requires --bases)",
+    )
+    parser.add_argument(
+        "--lock",
+        help="Lock file with commit of each ref in charms.json (from previous release). "
+        "Overwritten with current commits",
+    )
+    parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        help="Only output charms with a ref that changed since lock file. All refs of a changed "
+        "charm are output (since they share one release archive)",
+    )
+    parser.add_argument(
+        "--durations",
+        help="JSON file with build duration of each charm base (from previous release). Jobs are "
+        "ordered longest first",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Split jobs into this many build matrices (output as charms_0, charms_1, ...) to "
+        f"exceed the limit of {_MAX_JOBS_PER_MATRIX} jobs per matrix",
     )
-    charm_refs = (
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=20,
+        help="Maximum concurrent jobs per runner type (to estimate makespan)",
+    )
+    args = parser.parse_args()
+    if args.changed_only and not args.lock:
+        parser.error("--changed-only requires --lock")
+    if args.group_by_repository and not args.bases:
+        parser.error("--group-by-repository requires --bases")
+    charm_refs = [
+        charm.CharmRef(**charm_) for charm_ in json.loads(pathlib.Path("charms.json").read_text())
+    ]
+    jobs = [
         _CharmRefJob.from_charm_ref(charm_ref, index=index)
         for index, charm_ref in enumerate(charm_refs)
-    )
-    charm_refs = [dataclasses.asdict(charm_ref) for charm_ref in charm_refs]
-    output = f"charms={json.dumps(charm_refs)}\n"
+    ]
+    if args.lock:
+        # Resolve once so that bases (cached by commit) & lock file are from the same commits
+        charm_refs = lock.resolve(charm_refs, max_workers=args.jobs)
+    if args.bases:
+        bases_cache = pathlib.Path(args.bases_cache) if args.bases_cache else None
+        charm_bases = collect_bases.collect(
+            charm_refs, max_workers=args.jobs, cache_path=bases_cache
+        )
+        jobs = [
+            _CharmRefBaseJob.from_charm_ref_job(job, base=base)
+            for job, bases in zip(jobs, charm_bases)
+            for base in bases
+        ]
+    if args.lock:
+        changed_charms = _changed_charms(charm_refs, lock_path=pathlib.Path(args.lock))
+        print(f"[ccc-hub] {len(changed_charms)} charms changed since lock file", flush=True)
+        if args.changed_only:
+            jobs = [
+                job
+                for job in jobs
+                if (job.github_repository, job.relative_path_to_charmcraft_yaml) in changed_charms
+            ]
+    output = ""
+    # Compact JSON: size of outputs is limited
+    # (https://docs.github.com/en/actions/writing-workflows/workflow-syntax-for-github-actions#jobsjob_idoutputs)
+    separators = (",", ":")
+    if args.bases:
+        # One shared wheelhouse per base, for the charms that are built (e.g. with --changed-only)
+        bases = {}
+        for job in jobs:
+            base = bases.setdefault(
+                job.base.name_in_artifact,
+                {
+                    "name": job.base.name,
+                    "name_in_artifact": job.base.name_in_artifact,
+                    "runner": job.base.runner,
+                    # Indexes in charms.json
+                    "charm_indexes": [],
+                },
+            )
+            if job.charm_index not in base["charm_indexes"]:
+                base["charm_indexes"].append(job.charm_index)
+        output += f"bases={json.dumps(list(bases.values()), separators=separators)}\n"
+    estimates = [0.0] * len(jobs)
+    if args.durations:
+        durations = _read_durations(pathlib.Path(args.durations))
+        # Charms without previous duration (e.g. new charms) are assumed to take the median time
+        default = statistics.median(durations.values()) if durations else 0.0
+        estimates = [_estimate_duration(job, durations=durations, default=default) for job in jobs]
+    if args.group_by_repository:
+        jobs, estimates = _group_by_repository(jobs, estimates=estimates)
+        print(f"[ccc-hub] Grouped charm bases into {len(jobs)} jobs", flush=True)
+    if args.durations:
+        makespan_before = _makespan(
+            [(_runner(job), seconds) for job, seconds in zip(jobs, estimates)],
+            concurrency=args.concurrency,
+        )
+        # GitHub Actions starts matrix jobs in order; longest first minimizes makespan
+        # (Sort is stable: jobs with equal estimates stay in charms.json order)
+        order = sorted(range(len(jobs)), key=lambda index: estimates[index], reverse=True)
+        jobs = [jobs[index] for index in order]
+        estimates = [estimates[index] for index in order]
+        makespan = _makespan(
+            [(_runner(job), seconds) for job, seconds in zip(jobs, estimates)],
+            concurrency=args.concurrency,
+        )
+        print(
+            f"[ccc-hub] Estimated makespan: {makespan / 60:.1f} minutes ({makespan_before / 60:.1f} "
+            f"minutes in charms.json order) from {len(durations)} previous durations",
+            flush=True,
+        )
+        output += f"estimated_makespan_seconds={round(makespan)}\n"
+    if args.shards:
+        for index, shard in enumerate(_shard(jobs, estimates=estimates, shards=args.shards)):
+            shard = [dataclasses.asdict(job) for job in shard]
+            output += f"charms_{index}={json.dumps(shard, separators=separators)}\n"
+            print(f"[ccc-hub] Shard {index}: {len(shard)} jobs", flush=True)
+    else:
+        jobs = [dataclasses.asdict(job) for job in jobs]
+        output = f"charms={json.dumps(jobs, separators=separators)}\n" + output
+    print(f"[ccc-hub] Output size: {len(output.encode()) / 1024:.1f} KiB", flush=True)
     print(output)
     with pathlib.Path(os.environ["GITHUB_OUTPUT"]).open("a", encoding="utf-8") as file:
         file.write(output)
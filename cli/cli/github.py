@@ -0,0 +1,315 @@
+import concurrent.futures
+import datetime
+import os
+import pathlib
+import threading
+import time
+import typing
+
+import requests
+import requests.adapters
+import uritemplate
+import urllib3
+import urllib3.util
+
+
+class GitHubRateLimitRetry(urllib3.util.Retry):
+    """Infinite retry for GitHub REST API rate limit
+
+    https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api?apiVersion=2022-11-28#exceeding-the-rate-limit
+    """
+
+    def __init__(self, **kwargs):
+        # Use setdefault since this class is re-initialized on each retry
+        # (using values from last retry)
+
+        # Infinite retry
+        assert kwargs.setdefault("total", None) is None
+        # Only retry on status code
+        # `<=0` since count is decremented & this class is re-initialized with `-1` before retry is
+        # stopped
+        assert kwargs.setdefault("connect", 0) <= 0
+        assert kwargs.setdefault("read", 0) <= 0
+        assert kwargs.setdefault("redirect", 0) <= 0
+        assert kwargs.setdefault("status", None) is None
+        assert kwargs.setdefault("other", 0) <= 0
+
+        allowed_methods = (*urllib3.util.Retry.DEFAULT_ALLOWED_METHODS, "POST", "PATCH")
+        assert kwargs.setdefault("allowed_methods", allowed_methods) == allowed_methods
+        assert kwargs.setdefault("status_forcelist", (403, 429)) == (403, 429)
+        assert kwargs.setdefault("respect_retry_after_header", True) is True
+        super().__init__(**kwargs)
+
+    def get_retry_after(self, response: urllib3.BaseHTTPResponse) -> float | None:
+        seconds = super().get_retry_after(response)
+        if seconds:
+            print(f"[ccc-hub] Rate limit exceeded. Sleeping for {int(seconds)} seconds", flush=True)
+        return seconds
+
+    def sleep_for_retry(self, response: urllib3.BaseHTTPResponse) -> bool:
+        # Sleep until x-ratelimit-reset
+        if int(response.headers.get("x-ratelimit-remaining", -1)) == 0 and (
+            reset := response.headers.get("x-ratelimit-reset")
+        ):
+            retry_time = datetime.datetime.fromtimestamp(float(reset), tz=datetime.timezone.utc)
+            retry_delta = retry_time - datetime.datetime.now(tz=datetime.timezone.utc)
+            seconds = max(retry_delta.total_seconds(), 0)
+            print(f"[ccc-hub] Rate limit exceeded. Sleeping for {int(seconds)} seconds", flush=True)
+            time.sleep(seconds)
+            return True
+        # Sleep for/until retry-after
+        if super().sleep_for_retry(response):
+            return True
+        # x-ratelimit-reset and retry-after headers missing
+        print(
+            "[ccc-hub] Rate limit exceeded. Sleeping for 60 seconds (rate limit headers missing)",
+            flush=True,
+        )
+        time.sleep(60)
+        return True
+
+
+class _RateLimitPacer:
+    """Pace requests to stay within GitHub rate limits instead of waiting after limit is exceeded
+
+    - Primary rate limit: when few requests remain (from `x-ratelimit-remaining` of every
+      response), requests are spread evenly until the limit resets (`x-ratelimit-reset`)
+    - Secondary rate limit: content-creating requests (e.g. release asset uploads) are spaced so
+      that no more than 80 are sent per minute
+    - Concurrency: additive increase, multiplicative decrease. The number of concurrent requests is
+      halved when a request is rate limited & increased by 1 / (current concurrency) for each
+      request that is not (i.e. by about 1 per round of requests), up to `max_concurrency`
+
+    Shared by all threads that use a session
+
+    https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api?apiVersion=2022-11-28#avoid-concurrent-requests
+    """
+
+    # Start pacing when fewer requests remain
+    _PACING_THRESHOLD = 500
+    # https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api?apiVersion=2022-11-28#about-secondary-rate-limits
+    _CONTENT_CREATING_METHODS = ("POST", "PATCH", "PUT", "DELETE")
+    _CONTENT_CREATING_INTERVAL = 60 / 80
+
+    def __init__(self, *, max_concurrency: int):
+        self._condition = threading.Condition()
+        self._max_concurrency = max_concurrency
+        self._concurrency = float(max_concurrency)
+        self._in_flight = 0
+        self._remaining: int | None = None
+        # Unix time
+        self._reset: float | None = None
+        # `time.monotonic()` time when next request/content-creating request can be sent
+        self._next_request = 0.0
+        self._next_content_creating_request = 0.0
+
+    def acquire(self, method: str):
+        """Wait until request can be sent"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < int(self._concurrency))
+            self._in_flight += 1
+            now = time.monotonic()
+            start = now
+            if self._remaining is not None and self._remaining < self._PACING_THRESHOLD:
+                interval = max(self._reset - time.time(), 0) / max(self._remaining, 1)
+                start = max(start, self._next_request)
+                self._next_request = start + interval
+                # Each paced request uses one of the remaining requests
+                self._remaining -= 1
+            if method in self._CONTENT_CREATING_METHODS:
+                start = max(start, self._next_content_creating_request)
+                self._next_content_creating_request = start + self._CONTENT_CREATING_INTERVAL
+        if (delay := start - now) > 0:
+            if delay >= 1:
+                print(
+                    f"[ccc-hub] Pacing GitHub API requests. Sleeping for {delay:.1f} seconds",
+                    flush=True,
+                )
+            time.sleep(delay)
+
+    def release(self, response: requests.Response | None):
+        """Update rate limit state from response (`None` if request failed)"""
+        with self._condition:
+            self._in_flight -= 1
+            if response is not None:
+                if (remaining := response.headers.get("x-ratelimit-remaining")) and (
+                    reset := response.headers.get("x-ratelimit-reset")
+                ):
+                    self._remaining = int(remaining)
+                    self._reset = float(reset)
+                # Statuses of responses retried by `GitHubRateLimitRetry`
+                retries = getattr(response.raw, "retries", None)
+                statuses = [history.status for history in retries.history] if retries else []
+                if any(status in (403, 429) for status in (*statuses, response.status_code)):
+                    self._concurrency = max(self._concurrency / 2, 1)
+                    print(
+                        "[ccc-hub] Rate limited. Reduced concurrent GitHub API requests to "
+                        f"{int(self._concurrency)}",
+                        flush=True,
+                    )
+                else:
+                    self._concurrency = min(
+                        self._concurrency + 1 / self._concurrency, self._max_concurrency
+                    )
+            self._condition.notify_all()
+
+
+class _PacedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, *, pacer: _RateLimitPacer, **kwargs):
+        self._pacer = pacer
+        super().__init__(**kwargs)
+
+    def send(self, request: requests.PreparedRequest, *args, **kwargs):
+        self._pacer.acquire(request.method)
+        response = None
+        try:
+            response = super().send(request, *args, **kwargs)
+            return response
+        finally:
+            self._pacer.release(response)
+
+
+def session(*, pool_maxsize=10):
+    """GitHub REST API session
+
+    Authenticated with `GH_TOKEN` environment variable, paces requests to stay within rate limits
+    & retries on rate limit
+
+    `pool_maxsize` is the number of connections kept open to each host & the maximum number of
+    concurrent requests (set to the number of threads that use the session concurrently)
+    """
+    session_ = requests.Session()
+    session_.mount(
+        "https://",
+        _PacedHTTPAdapter(
+            pacer=_RateLimitPacer(max_concurrency=pool_maxsize),
+            max_retries=GitHubRateLimitRetry(),
+            pool_maxsize=pool_maxsize,
+        ),
+    )
+    session_.headers.update(
+        {
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+            "Authorization": f'Bearer {os.environ["GH_TOKEN"]}',
+        }
+    )
+    return session_
+
+
+def latest_release(session_: requests.Session, /):
+    """Latest release of this repository (`GITHUB_REPOSITORY` environment variable)
+
+    Returns `None` if there is no release
+    """
+    response = session_.get(
+        f'https://api.github.com/repos/{os.environ["GITHUB_REPOSITORY"]}/releases/latest'
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
+
+
+def download(session_: requests.Session, url: str, *, path: pathlib.Path):
+    """Download release asset by API URL (`url` of asset)"""
+    with session_.get(url, headers={"Accept": "application/octet-stream"}, stream=True) as response:
+        response.raise_for_status()
+        with path.open("wb") as file:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                file.write(chunk)
+
+
+def download_asset(session_: requests.Session, release: dict, *, name: str, path: pathlib.Path):
+    """Download release asset
+
+    Returns `False` if asset not found in release
+    """
+    for asset in release["assets"]:
+        if asset["name"] == name:
+            break
+    else:
+        return False
+    download(session_, asset["url"], path=path)
+    print(f'[ccc-hub] Downloaded {name} from release {release["name"]}', flush=True)
+    return True
+
+
+def _delete_asset(session_: requests.Session, release: dict, *, name: str):
+    """Delete asset from release (e.g. partially uploaded asset) if it exists"""
+    url = release["assets_url"]
+    while url:
+        response = session_.get(url, params={"per_page": 100})
+        response.raise_for_status()
+        for asset in response.json():
+            if asset["name"] == name:
+                session_.delete(asset["url"]).raise_for_status()
+                print(f"[ccc-hub] Deleted partially uploaded {name}", flush=True)
+                return
+        url = response.links.get("next", {}).get("url")
+
+
+def upload_asset(session_: requests.Session, release: dict, path: pathlib.Path, *, attempts=3):
+    """Upload file to release"""
+    with path.open("rb") as file:
+        upload_file(session_, release, file, name=path.name, attempts=attempts)
+
+
+def upload_file(
+    session_: requests.Session, release: dict, file: typing.BinaryIO, *, name: str, attempts=3
+):
+    """Upload seekable binary file object (e.g. `io.BytesIO`) to release as asset `name`
+
+    Rate limits are paced & retried by the session. Other failures (e.g. connection reset) are retried
+    up to `attempts` times in total; a partially uploaded asset is deleted before each retry
+    """
+    url = uritemplate.URITemplate(release["upload_url"]).expand(name=name)
+    for attempt in range(1, attempts + 1):
+        try:
+            file.seek(0)
+            response = session_.post(
+                url, headers={"Content-Type": "application/octet-stream"}, data=file
+            )
+            response.raise_for_status()
+            return
+        except requests.RequestException as exception:
+            if attempt == attempts:
+                raise
+            print(
+                f"[ccc-hub] Upload of {name} failed ({exception}). Retrying "
+                f"(attempt {attempt + 1}/{attempts})",
+                flush=True,
+            )
+            time.sleep(2**attempt)
+            _delete_asset(session_, release, name=name)
+
+
+def upload_assets(
+    session_: requests.Session, release: dict, paths: list[pathlib.Path], *, max_workers: int
+):
+    """Upload files to release concurrently
+
+    Use a session with `pool_maxsize` >= `max_workers`
+    """
+    total_bytes = sum(path.stat().st_size for path in paths)
+    start = time.monotonic()
+    lock = threading.Lock()
+    uploaded_files = 0
+    uploaded_bytes = 0
+
+    def upload(path: pathlib.Path):
+        nonlocal uploaded_files, uploaded_bytes
+        upload_asset(session_, release, path)
+        with lock:
+            uploaded_files += 1
+            uploaded_bytes += path.stat().st_size
+            print(
+                f"[ccc-hub] Uploaded {path.name} ({uploaded_files}/{len(paths)} files, "
+                f"{uploaded_bytes / 1024**2:.1f}/{total_bytes / 1024**2:.1f} MiB, "
+                f"{time.monotonic() - start:.0f}s)",
+                flush=True,
+            )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Raise exception if upload failed
+        list(executor.map(upload, paths))
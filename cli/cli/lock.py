@@ -0,0 +1,131 @@
+import argparse
+import concurrent.futures
+import dataclasses
+import json
+import pathlib
+import re
+import subprocess
+
+from . import charm, checkout
+
+
+def _resolve(ref: str, remote_refs: dict[str, str]):
+    """Resolve ref to commit sha with the same precedence as `git rev-parse`
+
+    https://git-scm.com/docs/gitrevisions#Documentation/gitrevisions.txt-emltrefnamegtemegmasterheadsmasterrefsheadsmaster
+
+    Returns `None` if ref not found
+    """
+    if re.fullmatch("[0-9a-f]{40}", ref):
+        return ref
+    for candidate in (
+        ref,
+        f"refs/{ref}",
+        f"refs/tags/{ref}",
+        f"refs/heads/{ref}",
+        f"refs/remotes/{ref}",
+        f"refs/remotes/{ref}/HEAD",
+    ):
+        # Peeled annotated tag (commit that the tag points to)
+        if commit := remote_refs.get(f"{candidate}^{{}}"):
+            return commit
+        if commit := remote_refs.get(candidate):
+            return commit
+
+
+def _resolve_repository(github_repository: str, refs: set[str]):
+    """Resolve refs of one repository with a single `git ls-remote` call
+
+    Returns mapping of ref to commit sha
+
+    Raises `checkout.CharmNotFound`
+    """
+    # Commit shas do not need to be resolved & would not match any remote ref name
+    patterns = sorted(ref for ref in refs if not re.fullmatch("[0-9a-f]{40}", ref))
+    # Include peeled annotated tags (e.g. "refs/tags/v1^{}")
+    patterns += [f"{pattern}^{{}}" for pattern in patterns]
+    remote_refs = {}
+    if patterns:
+        try:
+            output = subprocess.run(
+                ["git", "ls-remote", f"https://github.com/{github_repository}.git", *patterns],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+        except subprocess.CalledProcessError as exception:
+            if "ERROR: Repository not found." in exception.stderr:
+                raise checkout.CharmNotFound(f"{github_repository=} not found")
+            else:
+                raise
+        for line in output.splitlines():
+            commit, remote_ref = line.split("\t")
+            remote_refs[remote_ref] = commit
+    commits = {}
+    for ref in refs:
+        commit = _resolve(ref, remote_refs)
+        if commit is None:
+            raise checkout.CharmNotFound(f"{ref=} not found in {github_repository=}")
+        commits[ref] = commit
+    return commits
+
+
+def resolve(charm_refs: list[charm.CharmRef], *, max_workers: int):
+    """Resolve refs to commit shas
+
+    Runs one `git ls-remote` per GitHub repository, up to `max_workers` concurrently
+
+    Returns resolved charm refs in the same order as `charm_refs`
+
+    Raises `checkout.CharmNotFound`
+    """
+    # Repository: refs
+    repositories: dict[str, set[str]] = {}
+    for charm_ref in charm_refs:
+        repositories.setdefault(charm_ref.github_repository, set()).add(charm_ref.ref)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            github_repository: executor.submit(_resolve_repository, github_repository, refs)
+            for github_repository, refs in repositories.items()
+        }
+        # Repository: ref: commit
+        commits = {
+            github_repository: future.result() for github_repository, future in futures.items()
+        }
+    return [
+        charm.ResolvedCharmRef(
+            **dataclasses.asdict(charm_ref),
+            commit=commits[charm_ref.github_repository][charm_ref.ref],
+        )
+        for charm_ref in charm_refs
+    ]
+
+
+def read(path: pathlib.Path):
+    """Read lock file
+
+    Returns empty list if file does not exist
+    """
+    if not path.exists():
+        return []
+    return [charm.ResolvedCharmRef(**charm_ref) for charm_ref in json.loads(path.read_text())]
+
+
+def write(path: pathlib.Path, resolved_charm_refs: list[charm.ResolvedCharmRef]):
+    path.write_text(
+        json.dumps([dataclasses.asdict(charm_ref) for charm_ref in resolved_charm_refs], indent=2)
+    )
+
+
+def main():
+    """Resolve refs in charms.json to commit shas & write lock file"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="charms.lock.json")
+    parser.add_argument("--jobs", type=int, default=8, help="Maximum concurrent `git ls-remote`")
+    args = parser.parse_args()
+    charm_refs = [
+        charm.CharmRef(**charm_) for charm_ in json.loads(pathlib.Path("charms.json").read_text())
+    ]
+    resolved_charm_refs = resolve(charm_refs, max_workers=args.jobs)
+    write(pathlib.Path(args.output), resolved_charm_refs)
+    print(f"[ccc-hub] Resolved {len(resolved_charm_refs)} refs to {args.output}", flush=True)
@@ -0,0 +1,154 @@
+import contextlib
+import json
+import os
+import pathlib
+import subprocess
+
+from . import collect_bases, timing
+
+# pip of Python virtual environment in instance
+PIP = "/root/venv/bin/pip"
+# Same images as charmcraft 2's LXD instances (via craft-providers)
+# https://github.com/canonical/craft-providers/blob/1.24.1/craft_providers/lxd/remotes.py
+_BUILDD_RELEASES_REMOTE = (
+    "craft-com.ubuntu.cloud-buildd",
+    "https://cloud-images.ubuntu.com/buildd/releases",
+)
+_BUILDD_DAILY_REMOTE = (
+    "craft-com.ubuntu.cloud-buildd-daily",
+    "https://cloud-images.ubuntu.com/buildd/daily",
+)
+_BUILDD_IMAGES = {
+    "20.04": (_BUILDD_RELEASES_REMOTE, "core20"),
+    "22.04": (_BUILDD_RELEASES_REMOTE, "core22"),
+    "24.04": (_BUILDD_DAILY_REMOTE, "core24"),
+}
+# Same pip as charmcraft 2's charm plugin: installed if venv's pip is older than minimum version
+# https://github.com/canonical/charmcraft/blob/2.7.1/charmcraft/charm_builder.py
+_MINIMUM_PIP_VERSION = (24, 1)
+_KNOWN_GOOD_PIP_URL = "https://files.pythonhosted.org/packages/c0/d0/9641dc7b05877874c6418f8034ddefc809495e65caa14d38c7551cd114bb/pip-24.1.1.tar.gz"
+
+
+def run(instance: str, command: list[str], *, timer: timing.Timer, phase: str):
+    """Run command in instance (in /root/)
+
+    Raises `subprocess.CalledProcessError`
+    """
+    timer.run(["lxc", "exec", instance, "--cwd", "/root", "--", *command], phase=phase)
+
+
+def _image(channel: str):
+    """Buildd image used by charmcraft 2 for Ubuntu version
+
+    Adds image remote if missing
+    """
+    (remote_name, remote_address), image_name = _BUILDD_IMAGES[channel]
+    remotes = json.loads(
+        subprocess.run(
+            ["lxc", "remote", "list", "--format=json"], capture_output=True, check=True, text=True
+        ).stdout
+    )
+    if remote_name not in remotes:
+        subprocess.run(
+            ["lxc", "remote", "add", remote_name, remote_address, "--protocol=simplestreams"],
+            check=True,
+        )
+    return f"{remote_name}:{image_name}"
+
+
+def _pip_version(instance: str):
+    """Version (major, minor) of pip in instance's Python virtual environment"""
+    result = subprocess.run(
+        ["lxc", "exec", instance, "--", PIP, "--version"],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    # Example: "pip 22.0.2 from /root/venv/lib/python3.10/site-packages/pip (python 3.10)"
+    return tuple(int(part) for part in result.stdout.split()[1].split(".")[:2])
+
+
+@contextlib.contextmanager
+def instance(
+    base: collect_bases.Base,
+    *,
+    name: str,
+    pip_cache_directory: pathlib.Path,
+    build_packages: list[str],
+    timer: timing.Timer,
+):
+    """Launch LXD instance of the same Ubuntu version as base with Python virtual environment
+
+    Same setup as the charmcraft 2 charm plugin: same buildd image, `pip_cache_directory` is
+    mounted at pip's cache directory, `build_packages` are installed with apt & pip is pinned to
+    the same version
+
+    Yields instance name
+
+    Instance is deleted on exit
+    """
+    # Example `base.name`: "ubuntu@22.04:amd64"
+    channel = base.name.removeprefix("ubuntu@").split(":")[0]
+    pip_cache_directory.mkdir(parents=True, exist_ok=True)
+    # Same as charmcraft's LXD instances (via craft-providers): files created by root in the
+    # instance are owned by the current user on the host
+    timer.run(
+        [
+            "lxc",
+            "init",
+            _image(channel),
+            name,
+            "--config",
+            f"raw.idmap=both {os.getuid()} 0",
+        ],
+        phase="container launch",
+    )
+    try:
+        subprocess.run(
+            [
+                "lxc",
+                "config",
+                "device",
+                "add",
+                name,
+                "pip-cache",
+                "disk",
+                f"source={pip_cache_directory}",
+                "path=/root/.cache/pip",
+            ],
+            check=True,
+        )
+        timer.run(["lxc", "start", name], phase="container launch")
+        # Wait for instance to boot (ignore exit code; non-zero if cloud-init degraded)
+        with timer.phase("container launch"):
+            subprocess.run(
+                ["lxc", "exec", name, "--", "cloud-init", "status", "--wait"], check=False
+            )
+        for command in (
+            ["apt-get", "update"],
+            [
+                "env",
+                "DEBIAN_FRONTEND=noninteractive",
+                "apt-get",
+                "install",
+                "--yes",
+                "python3-pip",
+                "python3-setuptools",
+                "python3-wheel",
+                "python3-venv",
+                "python3-dev",
+                *build_packages,
+            ],
+        ):
+            run(name, command, timer=timer, phase="system packages")
+        run(name, ["python3", "-m", "venv", "/root/venv"], timer=timer, phase="dependency install")
+        if _pip_version(name) < _MINIMUM_PIP_VERSION:
+            run(
+                name,
+                [PIP, "install", f"pip@{_KNOWN_GOOD_PIP_URL}"],
+                timer=timer,
+                phase="dependency install",
+            )
+        yield name
+    finally:
+        subprocess.run(["lxc", "delete", "--force", name], check=True)
@@ -1,75 +1,22 @@
+import argparse
+import concurrent.futures
+import contextlib
 import dataclasses
-import datetime
+import functools
+import hashlib
+import io
 import json
 import os
 import pathlib
 import shutil
 import subprocess
+import tempfile
 import time
+import typing
 
 import requests
-import requests.adapters
-import uritemplate
-import urllib3
-import urllib3.util
 
-from . import charm
-
-
-class GitHubRateLimitRetry(urllib3.util.Retry):
-    """Infinite retry for GitHub REST API rate limit
-
-    https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api?apiVersion=2022-11-28#exceeding-the-rate-limit
-    """
-
-    def __init__(self, **kwargs):
-        # Use setdefault since this class is re-initialized on each retry
-        # (using values from last retry)
-
-        # Infinite retry
-        assert kwargs.setdefault("total", None) is None
-        # Only retry on status code
-        # `<=0` since count is decremented & this class is re-initialized with `-1` before retry is
-        # stopped
-        assert kwargs.setdefault("connect", 0) <= 0
-        assert kwargs.setdefault("read", 0) <= 0
-        assert kwargs.setdefault("redirect", 0) <= 0
-        assert kwargs.setdefault("status", None) is None
-        assert kwargs.setdefault("other", 0) <= 0
-
-        allowed_methods = (*urllib3.util.Retry.DEFAULT_ALLOWED_METHODS, "POST", "PATCH")
-        assert kwargs.setdefault("allowed_methods", allowed_methods) == allowed_methods
-        assert kwargs.setdefault("status_forcelist", (403, 429)) == (403, 429)
-        assert kwargs.setdefault("respect_retry_after_header", True) is True
-        super().__init__(**kwargs)
-
-    def get_retry_after(self, response: urllib3.BaseHTTPResponse) -> float | None:
-        seconds = super().get_retry_after(response)
-        if seconds:
-            print(f"[ccc-hub] Rate limit exceeded. Sleeping for {int(seconds)} seconds", flush=True)
-        return seconds
-
-    def sleep_for_retry(self, response: urllib3.BaseHTTPResponse) -> bool:
-        # Sleep until x-ratelimit-reset
-        if int(response.headers.get("x-ratelimit-remaining", -1)) == 0 and (
-            reset := response.headers.get("x-ratelimit-reset")
-        ):
-            retry_time = datetime.datetime.fromtimestamp(float(reset), tz=datetime.timezone.utc)
-            retry_delta = retry_time - datetime.datetime.now(tz=datetime.timezone.utc)
-            seconds = max(retry_delta.total_seconds(), 0)
-            print(f"[ccc-hub] Rate limit exceeded. Sleeping for {int(seconds)} seconds", flush=True)
-            time.sleep(seconds)
-            return True
-        # Sleep for/until retry-after
-        if super().sleep_for_retry(response):
-            return True
-        # x-ratelimit-reset and retry-after headers missing
-        print(
-            "[ccc-hub] Rate limit exceeded. Sleeping for 60 seconds (rate limit headers missing)",
-            flush=True,
-        )
-        time.sleep(60)
-        return True
+from . import charm, github
 
 
 @dataclasses.dataclass(frozen=True, kw_only=True)
@@ -85,7 +32,400 @@ class _Charm:
         )
 
 
+# Archive format: file extension
+# ("pigz" is gzip compressed with multiple threads; same file format as "gztar")
+ARCHIVE_EXTENSIONS = {"gztar": ".tar.gz", "pigz": ".tar.gz", "zstd": ".tar.zst", "tar": ".tar"}
+# Compression level if not set (otherwise compressor default)
+# "gztar": same level as Python's `gzip` & `shutil.make_archive`
+_DEFAULT_COMPRESSION_LEVELS = {"gztar": 9}
+
+
+def archive_name_without_extension(charm_ref: charm.CharmRef, *, base_name_in_artifact: str):
+    """Release archive name for charm & base, without file extension"""
+    archive_name = (
+        f"{charm_ref.github_repository}_ccchub1_{charm_ref.relative_path_to_charmcraft_yaml}"
+        f"_ccchub2_{base_name_in_artifact}"
+    )
+    return archive_name.replace("/", "_")
+
+
+def _file_index(directory: pathlib.Path):
+    """Relative path: size of each file in directory"""
+    return {
+        path.relative_to(directory): path.lstat().st_size
+        for path in directory.rglob("*")
+        if path.is_symlink() or not path.is_dir()
+    }
+
+
+def _sha256(path: pathlib.Path):
+    hash_ = hashlib.sha256()
+    with path.open("rb") as file:
+        while chunk := file.read(1024 * 1024):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def _merge(sources: dict[int, pathlib.Path], destination: pathlib.Path):
+    """Merge source directories into destination directory
+
+    `sources`: index in charms.json: directory, in order of precedence (a file in an earlier
+    source is kept over a file with the same path in a later source)
+
+    Files are moved (renamed; no data is copied on the same filesystem). Files with the same path
+    in multiple sources are only compared (size, then sha256) with the file that is kept: identical
+    files are duplicates, other files are conflicts
+
+    Returns merge report
+    """
+    file_indexes = {index: _file_index(source) for index, source in sources.items()}
+    report = {"files": 0, "duplicate_files": 0, "bytes_saved": 0, "conflicts": []}
+    if len(sources) == 1:
+        # Nothing to compare; move entire directory
+        (index,) = sources
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(sources[index], destination)
+        report["files"] = len(file_indexes[index])
+        return report
+    for relative_path in sorted(set().union(*file_indexes.values())):
+        present = [index for index, files in file_indexes.items() if relative_path in files]
+        kept_index, *other_indexes = present
+        kept_size = file_indexes[kept_index][relative_path]
+        kept_sha256 = _sha256(sources[kept_index] / relative_path) if other_indexes else None
+        overridden = []
+        for index in other_indexes:
+            if (
+                file_indexes[index][relative_path] == kept_size
+                and _sha256(sources[index] / relative_path) == kept_sha256
+            ):
+                report["duplicate_files"] += 1
+                report["bytes_saved"] += kept_size
+            else:
+                overridden.append(index)
+        if overridden:
+            report["conflicts"].append(
+                {"path": str(relative_path), "kept_index": kept_index, "overridden": overridden}
+            )
+        target = destination / relative_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(sources[kept_index] / relative_path, target)
+        report["files"] += 1
+    return report
+
+
+def _directory_size(directory: pathlib.Path):
+    return sum(file.stat().st_size for file in directory.rglob("*") if file.is_file())
+
+
+def _archive_workers(directories: list[pathlib.Path], *, output_directory: pathlib.Path, jobs: int):
+    """Number of archives to create concurrently
+
+    Bounded by `jobs` & free disk space (an archive in progress can be as large as its
+    uncompressed directory)
+    """
+    if not directories:
+        return 1
+    largest = max(_directory_size(directory) for directory in directories)
+    free = shutil.disk_usage(output_directory).free
+    return max(min(jobs, len(directories), free // max(largest, 1)), 1)
+
+
+def _tar_command(
+    directory: pathlib.Path, *, file: str, archive_format: str, level: int | None, threads: int
+):
+    """tar command that writes archive of directory contents to `file` ("-" for stdout)"""
+    compress_program = {
+        "gztar": ["gzip"],
+        "pigz": ["pigz", f"--processes={threads}"],
+        "zstd": ["zstd", f"--threads={threads}"],
+        "tar": None,
+    }[archive_format]
+    if compress_program and level is not None:
+        compress_program.append(f"-{level}")
+    command = ["tar", "--create", f"--file={file}", f"--directory={directory}"]
+    if compress_program:
+        command.append(f'--use-compress-program={" ".join(compress_program)}')
+    # Example member name: "./BuilddBaseAlias.JAMMY/pip/..."
+    return [*command, "."]
+
+
+def _archive_stats(
+    *,
+    name: str,
+    archive_format: str,
+    level: int | None,
+    uncompressed_bytes: int,
+    compressed_bytes: int,
+    seconds: float,
+):
+    return {
+        "name": name,
+        "format": archive_format,
+        "level": level,
+        "uncompressed_bytes": uncompressed_bytes,
+        "compressed_bytes": compressed_bytes,
+        "ratio": round(uncompressed_bytes / compressed_bytes, 2) if compressed_bytes else None,
+        "seconds": round(seconds, 2),
+    }
+
+
+def _print_archive_stats(stats: dict, *, action="Created"):
+    print(
+        f'[ccc-hub] {action} archive {stats["name"]} '
+        f'({stats["uncompressed_bytes"] / 1024**2:.1f} MiB -> '
+        f'{stats["compressed_bytes"] / 1024**2:.1f} MiB in {stats["seconds"]:.1f}s)',
+        flush=True,
+    )
+
+
+def _create_archive(
+    directory: pathlib.Path,
+    *,
+    path_without_extension: pathlib.Path,
+    archive_format: str,
+    level: int | None,
+    threads: int,
+):
+    """Create archive of directory contents
+
+    Runs in process pool worker. Returns archive statistics
+    """
+    path = path_without_extension.with_name(
+        f"{path_without_extension.name}{ARCHIVE_EXTENSIONS[archive_format]}"
+    )
+    assert not path.exists()
+    uncompressed_bytes = _directory_size(directory)
+    start = time.monotonic()
+    subprocess.run(
+        _tar_command(
+            directory, file=str(path), archive_format=archive_format, level=level, threads=threads
+        ),
+        check=True,
+    )
+    return _archive_stats(
+        name=path.name,
+        archive_format=archive_format,
+        level=level,
+        uncompressed_bytes=uncompressed_bytes,
+        compressed_bytes=path.stat().st_size,
+        seconds=time.monotonic() - start,
+    )
+
+
+def _spool(stream: typing.BinaryIO, *, max_size: int) -> typing.BinaryIO:
+    """Read stream into memory, or into temporary file once larger than `max_size` bytes"""
+    # Close temporary file if reading fails
+    with contextlib.ExitStack() as stack:
+        file = io.BytesIO()
+        while chunk := stream.read(1024 * 1024):
+            if isinstance(file, io.BytesIO) and file.tell() + len(chunk) > max_size:
+                temporary_file = stack.enter_context(tempfile.TemporaryFile())
+                temporary_file.write(file.getbuffer())
+                file = temporary_file
+            file.write(chunk)
+        # Caller closes file
+        stack.pop_all()
+        return file
+
+
+def _stream_archive(
+    session: requests.Session,
+    release: dict,
+    directory: pathlib.Path,
+    *,
+    name: str,
+    archive_format: str,
+    level: int | None,
+    threads: int,
+    spool_size: int,
+):
+    """Create archive of directory contents & upload it to release without writing it to
+    release_archives/
+
+    GitHub needs the size of a release asset before upload, so the output of tar is spooled in
+    memory (in a temporary file beyond `spool_size` bytes) until compression finishes
+
+    Returns archive statistics
+    """
+    uncompressed_bytes = _directory_size(directory)
+    start = time.monotonic()
+    with subprocess.Popen(
+        _tar_command(
+            directory, file="-", archive_format=archive_format, level=level, threads=threads
+        ),
+        stdout=subprocess.PIPE,
+    ) as process:
+        file = _spool(process.stdout, max_size=spool_size)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+    seconds = time.monotonic() - start
+    with file:
+        compressed_bytes = file.seek(0, os.SEEK_END)
+        github.upload_file(session, release, file, name=name)
+    stats = _archive_stats(
+        name=name,
+        archive_format=archive_format,
+        level=level,
+        uncompressed_bytes=uncompressed_bytes,
+        compressed_bytes=compressed_bytes,
+        seconds=seconds,
+    )
+    _print_archive_stats(stats, action="Created & uploaded")
+    return stats
+
+
+def extract_archive(path: pathlib.Path, directory: pathlib.Path):
+    """Extract release archive (any format in `ARCHIVE_EXTENSIONS`) into directory"""
+    if path.name.endswith(ARCHIVE_EXTENSIONS["zstd"]):
+        directory.mkdir(parents=True, exist_ok=True)
+        subprocess.run(
+            ["tar", "--extract", f"--file={path}", f"--directory={directory}", "--zstd"],
+            check=True,
+        )
+    else:
+        shutil.unpack_archive(path, directory)
+
+
+def _release_json(session: requests.Session, release: dict, *, name: str):
+    """Contents of JSON file in release
+
+    Returns `None` if release does not contain file
+    """
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        path = pathlib.Path(temporary_directory, name)
+        if not github.download_asset(session, release, name=name, path=path):
+            return None
+        return json.loads(path.read_text())
+
+
+def available_archives(session: requests.Session, release: dict) -> dict[str, str]:
+    """Archive name: asset API URL of each archive available from release
+
+    Includes archives of previous releases listed in archive-manifest.json of release
+    (`release --incremental=manifest`)
+    """
+    archives = _release_json(session, release, name="archive-manifest.json") or {}
+    for asset in release["assets"]:
+        if asset["name"].endswith(tuple(ARCHIVE_EXTENSIONS.values())):
+            archives[asset["name"]] = asset["url"]
+    return archives
+
+
+def _content_sha256(directory: pathlib.Path):
+    """sha256 of directory contents (independent of archive format & compression)"""
+    hash_ = hashlib.sha256()
+    for relative_path in sorted(_file_index(directory)):
+        path = directory / relative_path
+        hash_.update(f"{relative_path.as_posix()}\0".encode())
+        hash_.update(f"{os.readlink(path) if path.is_symlink() else _sha256(path)}\0".encode())
+    return hash_.hexdigest()
+
+
+def _carry_forward_archives(
+    session: requests.Session,
+    release: dict,
+    *,
+    charm_refs: dict[_Charm, charm.CharmRef],
+    release_archives: pathlib.Path,
+    manifest: dict[str, str] | None,
+):
+    """Download archives of charms from release
+
+    If `manifest` is not `None`, archives are added to it instead of downloaded
+
+    Returns archive names
+    """
+    # Example: "canonical_mysql-router-k8s-operator_ccchub1_._ccchub2_"
+    prefixes = {
+        archive_name_without_extension(charm_ref, base_name_in_artifact=""): charm_
+        for charm_, charm_ref in charm_refs.items()
+    }
+    release_archives.mkdir(parents=True, exist_ok=True)
+    names = []
+    for name, url in available_archives(session, release).items():
+        if not any(name.startswith(prefix) for prefix in prefixes):
+            continue
+        if manifest is None:
+            github.download(session, url, path=release_archives / name)
+            print(f'[ccc-hub] Downloaded {name} from release {release["name"]}', flush=True)
+        else:
+            manifest[name] = url
+        names.append(name)
+    return names
+
+
+def _carry_forward_entries(
+    session: requests.Session, release: dict, *, name: str, charms: set[_Charm]
+) -> list[dict]:
+    """Entries of charms in release metadata file (e.g. dependency-hashes.json)"""
+    entries = _release_json(session, release, name=name) or []
+    return [
+        entry
+        for entry in entries
+        if _Charm(
+            github_repository=entry["github_repository"],
+            relative_path_to_charmcraft_yaml=entry["relative_path_to_charmcraft_yaml"],
+        )
+        in charms
+    ]
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--carry-forward-unchanged",
+        action="store_true",
+        help="Include archives & metadata of charms that were not built (i.e. not changed) from "
+        "latest release",
+    )
+    parser.add_argument(
+        "--archive-format",
+        choices=ARCHIVE_EXTENSIONS,
+        default="gztar",
+        help="gztar: gzip; pigz: gzip with multiple threads; zstd; tar: uncompressed",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Compression level (default: 9 for gztar, otherwise compressor default)",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        type=int,
+        help="Compression threads per archive (pigz & zstd; default: CPU count / archive jobs)",
+    )
+    parser.add_argument(
+        "--archive-jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Maximum archives created concurrently (also limited by free disk space)",
+    )
+    parser.add_argument(
+        "--upload-jobs", type=int, default=8, help="Maximum concurrent release file uploads"
+    )
+    parser.add_argument(
+        "--incremental",
+        choices=["reupload", "manifest"],
+        help="Do not create archives with the same contents as in latest release. reupload: "
+        "upload archive from latest release again; manifest: list asset URL of latest release in "
+        "archive-manifest.json (not supported by all consumers)",
+    )
+    parser.add_argument(
+        "--stream-archives",
+        action="store_true",
+        help="Upload each archive as soon as it is compressed instead of writing all archives to "
+        "disk first. Each archive is fully compressed (spooled) before its upload starts; "
+        "compression of one archive overlaps with uploads of other archives (--upload-jobs "
+        "archives at a time)",
+    )
+    parser.add_argument(
+        "--spool-size",
+        type=int,
+        default=256,
+        help="With --stream-archives, MiB of each compressed archive kept in memory before "
+        "spilling to a temporary file",
+    )
+    args = parser.parse_args()
     charm_refs = [
         charm.CharmRef(**charm_) for charm_ in json.loads(pathlib.Path("charms.json").read_text())
     ]
@@ -96,32 +436,67 @@ def main():
     for index, charm_ref in enumerate(charm_refs):
         charm_indexes.setdefault(_Charm.from_charm_ref(charm_ref), []).append(index)
     bases = pathlib.Path("~/charmcraftcache-hub-ci/bases/").expanduser()
+    # Grouped build jobs (`build --group`) upload one artifact with a directory for each charm base
+    # Example: "charms-0/charm-0-base-ubuntu@22.04_ccchubbase_amd64"
+    for group in bases.glob("charms-*"):
+        for base in group.iterdir():
+            base.rename(bases / base.name)
+        group.rmdir()
     combined_bases = pathlib.Path("~/charmcraftcache-hub-ci/combined_bases/").expanduser()
+    merge_reports = []
     for charm_, indexes in charm_indexes.items():
-        # Lower index (earlier in charms.json list) should override higher index
-        # `shutil.copytree` with `dirs_exist_ok=True` provides this behavior if we copy higher
-        # indexes before lower indexes
-        for index in reversed(indexes):
-            # Example `base`: "charm-0-base-ubuntu@22.04_ccchubbase_amd64"
+        # Base name in artifact: {index in charms.json: base directory}
+        # Example `base`: "charm-0-base-ubuntu@22.04_ccchubbase_amd64"
+        charm_bases: dict[str, dict[int, pathlib.Path]] = {}
+        for index in indexes:
             for base in bases.glob(f"charm-{index}-*"):
-                # Remove charmcraft base directory (e.g. "charmcraft-buildd-base-v7") when copying
+                base_name = base.name.removeprefix(f"charm-{index}-base-")
+                charm_bases.setdefault(base_name, {})[index] = base
+        for base_name, base_directories in charm_bases.items():
+            # Remove charmcraft base directory (e.g. "charmcraft-buildd-base-v7") when merging
+            sources = {}
+            for index, base in base_directories.items():
                 base_subdirectories = list(base.iterdir())
                 assert len(base_subdirectories) == 1
                 # Example `base_subdirectory.name`: "charmcraft-buildd-base-v7"
-                base_subdirectory = base_subdirectories[0]
-                shutil.copytree(
-                    base_subdirectory,
-                    combined_bases / base.name.replace(f"charm-{index}-", f"charm-{min(indexes)}-"),
-                    dirs_exist_ok=True,
-                )
+                sources[index] = base_subdirectories[0]
+            # Lower index (earlier in charms.json list) should override higher index
+            # (`indexes` & `base_directories` are sorted by index)
+            report = _merge(sources, combined_bases / f"charm-{min(indexes)}-base-{base_name}")
+            for base in base_directories.values():
                 shutil.rmtree(base)
+            merge_reports.append(
+                {
+                    **dataclasses.asdict(charm_),
+                    "base_name_in_artifact": base_name,
+                    "indexes": list(sources),
+                    **report,
+                }
+            )
+            if report["conflicts"]:
+                print(
+                    f'[ccc-hub] {len(report["conflicts"])} conflicting files for {charm_=} '
+                    f"{base_name=} (kept file from lowest index): "
+                    f'{[conflict["path"] for conflict in report["conflicts"]]}',
+                    flush=True,
+                )
         print(f"[ccc-hub] Merged {indexes=} for {charm_=}", flush=True)
     # Check directory is empty
     bases.rmdir()
-    print("[ccc-hub] Merged bases", flush=True)
+    print(
+        f'[ccc-hub] Merged bases ({sum(report["duplicate_files"] for report in merge_reports)} '
+        f'duplicate files, {sum(report["bytes_saved"] for report in merge_reports) / 1024**2:.1f} '
+        f'MiB saved, {sum(len(report["conflicts"]) for report in merge_reports)} conflicts)',
+        flush=True,
+    )
 
     release_archives = pathlib.Path("~/charmcraftcache-hub-ci/release_archives/").expanduser()
-    for base in combined_bases.iterdir():
+    release_archives.mkdir(parents=True, exist_ok=True)
+    extension = ARCHIVE_EXTENSIONS[args.archive_format]
+    # Combined base directory: archive name without extension
+    archive_names: dict[pathlib.Path, str] = {}
+    # Sort for deterministic log output
+    for base in sorted(combined_bases.iterdir()):
         base: pathlib.Path
         # Example: "charm-0-base-ubuntu@22.04_ccchubbase_amd64"
         artifact_name = base.name
@@ -129,18 +504,205 @@ def main():
         assert first == "charm" and third == "base"
         charm_index = int(charm_index)
         charm_ref = charm_refs[charm_index]
-        archive_name = f"{charm_ref.github_repository}_ccchub1_{charm_ref.relative_path_to_charmcraft_yaml}_ccchub2_{base_name}"
-        archive_name = archive_name.replace("/", "_")
-        archive_path_without_extension = release_archives / archive_name
-        expected_archive_path = release_archives / f"{archive_name}.tar.gz"
-        assert not expected_archive_path.exists()
-        created_archive_path = shutil.make_archive(
-            base_name=str(archive_path_without_extension), format="gztar", root_dir=base
-        )
-        created_archive_path = pathlib.Path(created_archive_path)
-        assert created_archive_path == expected_archive_path
-        print(f"[ccc-hub] Created archive {created_archive_path.name}", flush=True)
-    print("[ccc-hub] Created all archives", flush=True)
+        archive_name = archive_name_without_extension(charm_ref, base_name_in_artifact=base_name)
+        assert not (release_archives / f"{archive_name}{extension}").exists()
+        archive_names[base] = archive_name
+    # Archive name: sha256 of archive contents
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        archive_hashes = dict(
+            zip(
+                (f"{archive_name}{extension}" for archive_name in archive_names.values()),
+                executor.map(_content_sha256, archive_names),
+            )
+        )
+    session = github.session(pool_maxsize=args.upload_jobs)
+    latest_release = None
+    previous_archive_hashes = {}
+    if args.carry_forward_unchanged or args.incremental:
+        latest_release = github.latest_release(session)
+    if latest_release:
+        previous_archive_hashes = (
+            _release_json(session, latest_release, name="archive-hashes.json") or {}
+        )
+    # Archive name: asset API URL of archive in a previous release
+    archive_manifest = {}
+    if args.incremental and latest_release:
+        previous_archives = available_archives(session, latest_release)
+        unchanged = [
+            name
+            for name, sha256 in archive_hashes.items()
+            if previous_archive_hashes.get(name) == sha256 and name in previous_archives
+        ]
+        archive_names = {
+            base: archive_name
+            for base, archive_name in archive_names.items()
+            if f"{archive_name}{extension}" not in unchanged
+        }
+        for name in unchanged:
+            if args.incremental == "manifest":
+                archive_manifest[name] = previous_archives[name]
+            else:
+                # GitHub does not support copying release assets; download & upload again
+                github.download(session, previous_archives[name], path=release_archives / name)
+        print(
+            f"[ccc-hub] {len(unchanged)}/{len(archive_hashes)} archives unchanged since release "
+            f'{latest_release["name"]} ('
+            + (
+                "listed in archive-manifest.json"
+                if args.incremental == "manifest"
+                else "uploaded again"
+            )
+            + ")",
+            flush=True,
+        )
+    if args.stream_archives:
+        # Archives are created after the release is created
+        workers = args.upload_jobs
+    else:
+        workers = _archive_workers(
+            list(archive_names), output_directory=release_archives, jobs=args.archive_jobs
+        )
+    compression_threads = args.compression_threads or max(os.cpu_count() // workers, 1)
+    compression_level = (
+        args.compression_level
+        if args.compression_level is not None
+        else _DEFAULT_COMPRESSION_LEVELS.get(args.archive_format)
+    )
+    archive_stats = []
+    if not args.stream_archives:
+        print(
+            f"[ccc-hub] Creating {len(archive_names)} archives with {workers} processes",
+            flush=True,
+        )
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _create_archive,
+                    base,
+                    path_without_extension=release_archives / archive_name,
+                    archive_format=args.archive_format,
+                    level=compression_level,
+                    threads=compression_threads,
+                )
+                for base, archive_name in archive_names.items()
+            ]
+            # Log in submission order
+            for future, archive_name in zip(futures, archive_names.values()):
+                stats = future.result()
+                expected_archive_path = release_archives / f"{archive_name}{extension}"
+                assert release_archives / stats["name"] == expected_archive_path
+                assert expected_archive_path.exists()
+                _print_archive_stats(stats)
+                archive_stats.append(stats)
+        print("[ccc-hub] Created all archives", flush=True)
+
+    # Files (other than archives) to include in release (e.g. bases cache)
+    release_metadata = pathlib.Path("~/charmcraftcache-hub-ci/release_metadata/").expanduser()
+    # Combine dependency hash of each charm base build into one file
+    # Example: "~/charmcraftcache-hub-ci/dependency_hashes/dependency-hashes-0/charm-0-base-ubuntu@22.04_ccchubbase_amd64.json"
+    dependency_hashes = [
+        json.loads(path.read_text())
+        for path in sorted(
+            pathlib.Path("~/charmcraftcache-hub-ci/dependency_hashes/")
+            .expanduser()
+            .glob("*/*.json")
+        )
+    ]
+    release_metadata.mkdir(exist_ok=True)
+    # Duration of each charm base build, used to schedule the next build longest-first
+    # Example: "~/charmcraftcache-hub-ci/build_reports/build-reports-0/charm-0-base-ubuntu@22.04_ccchubbase_amd64.json"
+    build_durations = [
+        {
+            "github_repository": report["github_repository"],
+            "ref": report["ref"],
+            "relative_path_to_charmcraft_yaml": report["relative_path_to_charmcraft_yaml"],
+            "base_name_in_artifact": report["base_name_in_artifact"],
+            "seconds": report["total_seconds"],
+        }
+        for report in (
+            json.loads(path.read_text())
+            for path in sorted(
+                pathlib.Path("~/charmcraftcache-hub-ci/build_reports/")
+                .expanduser()
+                .glob("*/*.json")
+            )
+        )
+    ]
+    if args.carry_forward_unchanged and latest_release:
+        # Every charm base build writes a dependency hash
+        built_charms = {
+            _Charm(
+                github_repository=entry["github_repository"],
+                relative_path_to_charmcraft_yaml=entry["relative_path_to_charmcraft_yaml"],
+            )
+            for entry in dependency_hashes
+        }
+        unchanged_charms = set(charm_indexes) - built_charms
+        carried_forward_archives = _carry_forward_archives(
+            session,
+            latest_release,
+            charm_refs={
+                charm_: charm_refs[charm_indexes[charm_][0]] for charm_ in unchanged_charms
+            },
+            release_archives=release_archives,
+            manifest=archive_manifest if args.incremental == "manifest" else None,
+        )
+        archive_hashes.update(
+            (name, previous_archive_hashes[name])
+            for name in carried_forward_archives
+            if name in previous_archive_hashes
+        )
+        dependency_hashes += _carry_forward_entries(
+            session, latest_release, name="dependency-hashes.json", charms=unchanged_charms
+        )
+        build_durations += _carry_forward_entries(
+            session, latest_release, name="build-durations.json", charms=unchanged_charms
+        )
+        print(
+            f"[ccc-hub] Carried forward {len(unchanged_charms)} unchanged charms from release "
+            f'{latest_release["name"]}',
+            flush=True,
+        )
+    (release_metadata / "dependency-hashes.json").write_text(
+        json.dumps(dependency_hashes, indent=2)
+    )
+    (release_metadata / "build-durations.json").write_text(json.dumps(build_durations, indent=2))
+    # Shared wheelhouse jobs run before all build jobs; their duration is added to the critical path
+    # Example: "~/charmcraftcache-hub-ci/wheelhouse_reports/ubuntu@22.04_ccchubbase_amd64.json"
+    wheelhouse_durations = [
+        {
+            "base_name_in_artifact": report["base_name_in_artifact"],
+            "seconds": report["total_seconds"],
+            "phases": report["phases"],
+            "failed": report["failed"],
+        }
+        for report in (
+            json.loads(path.read_text())
+            for path in sorted(
+                pathlib.Path("~/charmcraftcache-hub-ci/wheelhouse_reports/")
+                .expanduser()
+                .glob("*.json")
+            )
+        )
+    ]
+    if wheelhouse_durations:
+        print(
+            "[ccc-hub] Shared wheelhouse added "
+            f'{max(entry["seconds"] for entry in wheelhouse_durations)}s to critical path '
+            "(slowest base)",
+            flush=True,
+        )
+    (release_metadata / "wheelhouse-durations.json").write_text(
+        json.dumps(wheelhouse_durations, indent=2)
+    )
+    # Duplicate & conflicting files of charms with multiple refs in charms.json
+    (release_metadata / "merge-report.json").write_text(json.dumps(merge_reports, indent=2))
+    # Used by `--incremental` to find unchanged archives in next release
+    (release_metadata / "archive-hashes.json").write_text(json.dumps(archive_hashes, indent=2))
+    if archive_manifest:
+        (release_metadata / "archive-manifest.json").write_text(
+            json.dumps(archive_manifest, indent=2)
+        )
 
     release_name = f"build-{int(time.time())}-v4"
     # Create git tag
@@ -148,18 +710,10 @@ def main():
     subprocess.run(["git", "push", "origin", release_name], check=True)
     print(f"[ccc-hub] Created & pushed git tag {release_name}", flush=True)
 
-    session = requests.Session()
-    session.mount("https://", requests.adapters.HTTPAdapter(max_retries=GitHubRateLimitRetry()))
-    headers = {
-        "Accept": "application/vnd.github+json",
-        "X-GitHub-Api-Version": "2022-11-28",
-        "Authorization": f'Bearer {os.environ["GH_TOKEN"]}',
-    }
     # Create draft release
     # (Wait until all release files uploaded before marking as latest, non-draft release)
     response = session.post(
         f'https://api.github.com/repos/{os.environ["GITHUB_REPOSITORY"]}/releases',
-        headers=headers,
         json={
             "tag_name": release_name,
             "target_commitish": os.environ["GITHUB_SHA"],
@@ -171,23 +725,47 @@ def main():
     response.raise_for_status()
     print("[ccc-hub] Created draft release", flush=True)
     data = response.json()
-    upload_url_template = uritemplate.URITemplate(data["upload_url"])
     release_id = data["id"]
+    if args.stream_archives:
+        print(
+            f"[ccc-hub] Creating & uploading {len(archive_names)} archives ({workers} at a time)",
+            flush=True,
+        )
+        stream_archive = functools.partial(
+            _stream_archive,
+            session,
+            data,
+            archive_format=args.archive_format,
+            level=compression_level,
+            threads=compression_threads,
+            spool_size=args.spool_size * 1024**2,
+        )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    stream_archive,
+                    base,
+                    name=f"{archive_name}{extension}",
+                )
+                for base, archive_name in archive_names.items()
+            ]
+            archive_stats = [future.result() for future in futures]
+        print("[ccc-hub] Created & uploaded all archives", flush=True)
+    # Compression ratio & time of each archive created in this build (not carried forward)
+    (release_metadata / "archive-stats.json").write_text(json.dumps(archive_stats, indent=2))
     # Upload release files
-    for path in release_archives.iterdir():
-        with path.open("rb") as file:
-            response = session.post(
-                upload_url_template.expand(name=path.name),
-                headers={**headers, "Content-Type": "application/octet-stream"},
-                data=file,
-            )
-        response.raise_for_status()
-        print(f"[ccc-hub] Uploaded {path.name}", flush=True)
+    # (With --stream-archives, release_archives/ only contains carried forward & unchanged
+    # archives)
+    github.upload_assets(
+        session,
+        data,
+        [*release_archives.iterdir(), *release_metadata.iterdir()],
+        max_workers=args.upload_jobs,
+    )
     print("[ccc-hub] Uploaded all release files", flush=True)
     # Mark release as latest
     response = session.patch(
         f'https://api.github.com/repos/{os.environ["GITHUB_REPOSITORY"]}/releases/{release_id}',
-        headers=headers,
         json={"draft": False, "make_latest": "true"},
     )
     response.raise_for_status()
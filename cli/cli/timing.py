@@ -0,0 +1,110 @@
+import contextlib
+import re
+import subprocess
+import time
+
+# Output line that starts a phase: phase name
+# (Matches output of `charmcraft pack -v` & pip)
+_PHASE_PATTERNS = (
+    (
+        re.compile(
+            r"Launching environment|Launching instance|Creating new instance|Starting instance"
+        ),
+        "container launch",
+    ),
+    (re.compile(r"Collecting |Downloading |Obtaining "), "dependency download"),
+    (re.compile(r"Installing build dependencies"), "build dependency install"),
+    (re.compile(r"Installing collected packages"), "dependency install"),
+    (re.compile(r"Packing the charm|Creating the package itself|Linting the charm"), "pack"),
+)
+# Example: "  Building wheel for cryptography (pyproject.toml): started"
+# (When output is not a TTY, pip also prints
+# "  Building wheel for cryptography (pyproject.toml): finished with status 'done'")
+_WHEEL_START_PATTERN = re.compile(r"Building wheel for (?P<package>\S+) \(.*\): started")
+# Example: "  Created wheel for cryptography: filename=cryptography-42.0.8-cp39-abi3-linux_x86_64.whl"
+_WHEEL_END_PATTERN = re.compile(
+    r"(Created|Failed to build|Failed building) wheel for (?P<package>\S+?):?\s"
+)
+
+
+class Timer:
+    """Attribute wall time of build to phases & to each wheel built from source
+
+    Phases are detected from the output of subprocesses
+    """
+
+    def __init__(self):
+        self._start = time.monotonic()
+        # Phase: seconds
+        self._phases: dict[str, float] = {}
+        # Package: seconds
+        self._wheels: dict[str, float] = {}
+
+    def _add_phase_time(self, phase: str, seconds: float):
+        self._phases[phase] = self._phases.get(phase, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, phase: str):
+        """Attribute wall time of block to phase"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._add_phase_time(phase, time.monotonic() - start)
+
+    def run(self, command: list[str], *, phase: str, **kwargs):
+        """Run command & print its output while it runs
+
+        Time is attributed to `phase` until output indicates that another phase started
+
+        Raises `subprocess.CalledProcessError`
+        """
+        current_phase = phase
+        # Package & start time of wheel currently being built
+        wheel = None
+        last_line_time = time.monotonic()
+        try:
+            with subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, **kwargs
+            ) as process:
+                for line in process.stdout:
+                    print(line, end="", flush=True)
+                    now = time.monotonic()
+                    # Time until this line was printed belongs to phase before this line
+                    self._add_phase_time(current_phase, now - last_line_time)
+                    last_line_time = now
+                    if match := _WHEEL_START_PATTERN.search(line):
+                        wheel = (match.group("package"), now)
+                        current_phase = "wheel build"
+                    elif (match := _WHEEL_END_PATTERN.search(line)) and wheel:
+                        package, start = wheel
+                        self._wheels[package] = self._wheels.get(package, 0) + now - start
+                        wheel = None
+                        current_phase = "dependency install"
+                    else:
+                        for pattern, phase_ in _PHASE_PATTERNS:
+                            if pattern.search(line):
+                                current_phase = phase_
+                                break
+        finally:
+            now = time.monotonic()
+            self._add_phase_time(current_phase, now - last_line_time)
+            if wheel:
+                # Wheel build interrupted (e.g. at job timeout)
+                package, start = wheel
+                self._wheels[package] = self._wheels.get(package, 0) + now - start
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    def report(self):
+        return {
+            "total_seconds": round(time.monotonic() - self._start, 1),
+            "phases": {phase: round(seconds, 1) for phase, seconds in self._phases.items()},
+            # Slowest first
+            "wheels": {
+                package: round(seconds, 1)
+                for package, seconds in sorted(
+                    self._wheels.items(), key=lambda item: item[1], reverse=True
+                )
+            },
+        }
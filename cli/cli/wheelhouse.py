@@ -0,0 +1,224 @@
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import json
+import os
+import pathlib
+import re
+import shutil
+import subprocess
+import typing
+
+import yaml
+
+from . import charm, checkout, collect_bases, lock, lxd, timing
+
+
+def _normalize(name: str):
+    # https://packaging.python.org/en/latest/specifications/name-normalization/
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+@dataclasses.dataclass(frozen=True, kw_only=True)
+class _Requirement:
+    name: str
+    """Normalized package name"""
+
+    version: str
+    marker: str | None
+
+    @classmethod
+    def from_line(cls, line: str):
+        """Parse requirements.txt line
+
+        Returns `None` if version is not pinned (only pinned versions are shared between charms)
+        """
+        # Example: 'cryptography==42.0.8 ; python_version >= "3.8" --hash=sha256:...'
+        line = re.sub(r"\s--hash[=\s]\S+", "", line).strip()
+        requirement, _, marker = line.partition(";")
+        name, separator, version = requirement.partition("==")
+        if not separator or "@" in requirement:
+            return None
+        # Remove extras (they do not change the wheel)
+        name = name.split("[")[0].strip()
+        return cls(name=_normalize(name), version=version.strip(), marker=marker.strip() or None)
+
+    @property
+    def specifier(self):
+        if self.marker:
+            return f"{self.name}=={self.version}; {self.marker}"
+        return f"{self.name}=={self.version}"
+
+
+def source_requirements(
+    charmcraft_yaml: dict, *, read_file: typing.Callable[[str], str | None]
+) -> set[_Requirement]:
+    """Pinned requirements of charm that the charmcraft 2 charm plugin builds from source
+
+    `read_file` returns contents of file in charm directory or `None` if file does not exist
+    """
+    charm_part = charmcraft_yaml.get("parts", {}).get("charm", {})
+    lines = list(charm_part.get("charm-python-packages", []))
+    for requirements_file in charm_part.get("charm-requirements", ["requirements.txt"]):
+        if (contents := read_file(requirements_file)) is None:
+            continue
+        # Join continuation lines & remove comments
+        contents = re.sub(r"\\\n", " ", contents)
+        lines.extend(re.sub(r"(^|\s)#.*", "", line) for line in contents.splitlines())
+    requirements = (
+        _Requirement.from_line(line)
+        for line in lines
+        # Skip options (e.g. "--index-url")
+        if line.strip() and not line.strip().startswith("-")
+    )
+    return {requirement for requirement in requirements if requirement}
+
+
+def seed(
+    pip_cache_directory: pathlib.Path,
+    *,
+    wheelhouse_directory: pathlib.Path,
+    requirements: set[_Requirement],
+    source="shared wheelhouse",
+):
+    """Copy wheels of requirements from another pip cache into pip cache directory
+
+    `wheelhouse_directory` contains the wheels/ directory of a pip cache (e.g. shared wheelhouse
+    or previous release). Wheels of packages that are not in `requirements` are not copied (so
+    that they are not included in the release archive of the charm)
+    """
+    # (Normalized name, version)
+    wanted = {(requirement.name, requirement.version) for requirement in requirements}
+    copied = 0
+    for wheel in wheelhouse_directory.rglob("*.whl"):
+        # https://packaging.python.org/en/latest/specifications/binary-distribution-format/#file-name-convention
+        name, version = wheel.name.split("-")[:2]
+        if (_normalize(name), version) not in wanted:
+            continue
+        # Copy entire pip cache entry (wheel & origin.json)
+        entry = wheel.parent.relative_to(wheelhouse_directory)
+        shutil.copytree(wheel.parent, pip_cache_directory / "wheels" / entry, dirs_exist_ok=True)
+        copied += 1
+    print(
+        f"[ccc-hub] Copied {copied} wheels from {source} ({len(wanted)} requirements)",
+        flush=True,
+    )
+
+
+def _charm_requirements(charm_ref: charm.ResolvedCharmRef):
+    """Source requirements & apt build packages of charm
+
+    charmcraft.yaml & requirements files are read from one fetch of the resolved commit
+    """
+    commit_ref = charm.CharmRef(
+        github_repository=charm_ref.github_repository,
+        ref=charm_ref.commit,
+        relative_path_to_charmcraft_yaml=charm_ref.relative_path_to_charmcraft_yaml,
+    )
+    with checkout.file_reader(commit_ref) as read:
+        charmcraft_yaml = yaml.safe_load(read("charmcraft.yaml"))
+
+        def read_file(path: str):
+            try:
+                return read(path)
+            except checkout.CharmNotFound:
+                return None
+
+        requirements = source_requirements(charmcraft_yaml, read_file=read_file)
+    build_packages = charmcraft_yaml.get("parts", {}).get("charm", {}).get("build-packages", [])
+    return requirements, build_packages
+
+
+def main():
+    """Build wheels of requirements shared by charms in charms.json once per base
+
+    Each distinct (package, version) that a charm with the base builds from source is built once
+    into a pip cache directory. Charm builds copy the wheels they need from that directory
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--base-name-in-artifact", required=True, help="Base (e.g. 'ubuntu@22.04_ccchubbase_amd64')"
+    )
+    parser.add_argument("--jobs", type=int, default=8, help="Maximum concurrent git fetches")
+    parser.add_argument("--bases-cache", help="JSON file that caches bases by commit")
+    parser.add_argument(
+        "--charm-indexes",
+        help="JSON list of indexes in charms.json of charms to build wheels for (e.g. charms "
+        "selected by `collect-charms --changed-only`). Default: all charms",
+    )
+    args = parser.parse_args()
+    charm_refs = [
+        charm.CharmRef(**charm_) for charm_ in json.loads(pathlib.Path("charms.json").read_text())
+    ]
+    if args.charm_indexes is not None:
+        charm_refs = [charm_refs[index] for index in json.loads(args.charm_indexes)]
+    # Resolved once so that bases & requirements are read from the same commit
+    charm_refs = lock.resolve(charm_refs, max_workers=args.jobs)
+    charm_bases = collect_bases.collect(
+        charm_refs,
+        max_workers=args.jobs,
+        cache_path=pathlib.Path(args.bases_cache) if args.bases_cache else None,
+    )
+    matching = [
+        (charm_ref, base)
+        for charm_ref, bases in zip(charm_refs, charm_bases)
+        for base in bases
+        if base.name_in_artifact == args.base_name_in_artifact
+    ]
+    assert matching, f"No charms for {args.base_name_in_artifact=}"
+    base = matching[0][1]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        charm_requirements = list(
+            executor.map(_charm_requirements, dict.fromkeys(charm_ref for charm_ref, _ in matching))
+        )
+    # Requirement: number of charms
+    counts = collections.Counter(
+        requirement for requirements, _ in charm_requirements for requirement in requirements
+    )
+    build_packages = sorted({package for _, packages in charm_requirements for package in packages})
+    print(
+        f"[ccc-hub] {len(charm_requirements)} charms on {base.name} have {sum(counts.values())} "
+        f"source requirements ({len(counts)} distinct)",
+        flush=True,
+    )
+    timer = timing.Timer()
+    failed = []
+    try:
+        with lxd.instance(
+            base,
+            name=f"ccchub-wheelhouse-{os.getpid()}",
+            pip_cache_directory=pathlib.Path(
+                f"~/charmcraftcache-hub-ci/wheelhouse-pip-cache/{base.name_in_artifact}"
+            ).expanduser(),
+            build_packages=build_packages,
+            timer=timer,
+        ) as instance:
+            # Most shared first
+            for requirement, _ in counts.most_common():
+                try:
+                    lxd.run(
+                        instance,
+                        [lxd.PIP, "wheel", "--no-deps", "--no-binary=:all:", requirement.specifier],
+                        timer=timer,
+                        phase="dependency install",
+                    )
+                except subprocess.CalledProcessError:
+                    # Charm builds will build it (& report the error)
+                    failed.append(requirement.specifier)
+    finally:
+        # Build jobs wait for all wheelhouse jobs; included in release to track time added to
+        # critical path
+        report = {
+            "base_name_in_artifact": base.name_in_artifact,
+            **timer.report(),
+            "failed": failed,
+        }
+        report_path = pathlib.Path(
+            f"~/charmcraftcache-hub-ci/wheelhouse-reports/{base.name_in_artifact}.json"
+        ).expanduser()
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        report_path.write_text(json.dumps(report, indent=2))
+        print(f"[ccc-hub] Wheelhouse build report: {json.dumps(report)}", flush=True)
+    if failed:
+        print(f"[ccc-hub] Failed to build {len(failed)} wheels: {failed}", flush=True)
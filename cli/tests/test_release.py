@@ -0,0 +1,28 @@
+from cli import release
+
+
+def test_merge_lowest_index_wins(tmp_path):
+    # Index in charms.json: {path: contents}
+    files = {
+        0: {"pip/shared": "same", "pip/conflict": "index 0"},
+        1: {"pip/shared": "same", "pip/conflict": "index 1", "pip/only-1": "only"},
+        2: {"pip/shared": "same", "pip/conflict": "index 0"},
+    }
+    sources = {}
+    for index, contents in files.items():
+        sources[index] = tmp_path / f"source-{index}"
+        for path, text in contents.items():
+            (sources[index] / path).parent.mkdir(parents=True, exist_ok=True)
+            (sources[index] / path).write_text(text)
+    destination = tmp_path / "destination"
+    report = release._merge(sources, destination)
+    assert (destination / "pip/shared").read_text() == "same"
+    assert (destination / "pip/conflict").read_text() == "index 0"
+    assert (destination / "pip/only-1").read_text() == "only"
+    assert report == {
+        "files": 3,
+        # "pip/shared" in sources 1 & 2, "pip/conflict" in source 2
+        "duplicate_files": 3,
+        "bytes_saved": 2 * len("same") + len("index 0"),
+        "conflicts": [{"path": "pip/conflict", "kept_index": 0, "overridden": [1]}],
+    }
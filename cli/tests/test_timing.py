@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from cli import timing
+
+# Output of `pip install --no-binary=:all: cryptography==42.0.8` (not a TTY), shortened
+_PIP_OUTPUT = """\
+Collecting cryptography==42.0.8
+  Downloading cryptography-42.0.8.tar.gz (671 kB)
+  Installing build dependencies: started
+  Installing build dependencies: finished with status 'done'
+Building wheels for collected packages: cryptography
+  Building wheel for cryptography (pyproject.toml): started
+SLEEP
+  Building wheel for cryptography (pyproject.toml): finished with status 'done'
+  Created wheel for cryptography: filename=cryptography-42.0.8-cp39-abi3-linux_x86_64.whl size=1
+  Stored in directory: /root/.cache/pip/wheels/00/00
+Successfully built cryptography
+Installing collected packages: cryptography
+Successfully installed cryptography-42.0.8
+"""
+
+
+def test_run_wheel_time():
+    script = textwrap.dedent(f"""\
+        import time
+        for line in {_PIP_OUTPUT!r}.splitlines():
+            if line == "SLEEP":
+                time.sleep(0.5)
+            else:
+                print(line, flush=True)
+        """)
+    timer = timing.Timer()
+    timer.run([sys.executable, "-c", script], phase="dependency install")
+    report = timer.report()
+    assert list(report["wheels"]) == ["cryptography"]
+    assert report["wheels"]["cryptography"] >= 0.4
+    assert report["phases"]["wheel build"] >= 0.4
+
+
+def test_run_interrupted_wheel_time():
+    script = textwrap.dedent(f"""\
+        import sys, time
+        for line in {_PIP_OUTPUT!r}.splitlines():
+            if line == "SLEEP":
+                time.sleep(0.5)
+                sys.exit(1)
+            print(line, flush=True)
+        """)
+    timer = timing.Timer()
+    with pytest.raises(subprocess.CalledProcessError):
+        timer.run([sys.executable, "-c", script], phase="dependency install")
+    assert timer.report()["wheels"]["cryptography"] >= 0.4